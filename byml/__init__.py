@@ -1,4 +1,30 @@
-from .byml import *
+import importlib
+import sys
 
-from . import _version
-__version__ = _version.get_versions()['version']
+__all__ = ['NodeType', 'EventType', 'Byml', 'LazyArray', 'LazyHash', 'Writer', 'Int', 'Float', 'UInt', 'Int64', 'UInt64', 'Double',
+           'TypedArray', 'IntArray', 'UIntArray', 'FloatArray', 'Stats', 'ParseStats', 'WriteStats']
+
+if sys.version_info >= (3, 7):
+    # Only import the parser/writer and compute the version when they are actually used,
+    # so that lightweight modules such as byml.client start quickly.
+    def __getattr__(name: str):
+        if name == '__version__':
+            global __version__
+            __version__ = importlib.import_module('._version', __name__).get_versions()['version']
+            return __version__
+        try:
+            return getattr(importlib.import_module('.byml', __name__), name)
+        except AttributeError:
+            pass
+        # Submodules (e.g. byml.byml) were available right away when everything was imported eagerly.
+        try:
+            return importlib.import_module('.' + name, __name__)
+        except ModuleNotFoundError as e:
+            if e.name != '%s.%s' % (__name__, name):
+                raise
+        raise AttributeError('module %r has no attribute %r' % (__name__, name))
+else:
+    from .byml import *
+
+    from . import _version
+    __version__ = _version.get_versions()['version']
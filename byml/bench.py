@@ -0,0 +1,168 @@
+"""Benchmarks for the byml package. Run with python -m byml.bench."""
+import argparse
+import json
+import os
+import re
+import struct
+import subprocess
+import sys
+import time
+import typing
+
+IMPORT_TIME_MODULES = ['byml', 'byml.byml', 'byml.client', 'byml.byml_to_yml', 'byml.yml_to_byml']
+DEFAULT_DOCUMENT_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'test_data')
+
+_IMPORT_TIME_RE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+def measure_import_time(module: str) -> typing.Dict[str, int]:
+    """Import a module in a fresh interpreter with -X importtime and get the cumulative import time
+    (in microseconds) of every module that was imported."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    times: typing.Dict[str, int] = dict()
+    for line in result.stderr.splitlines():
+        match = _IMPORT_TIME_RE.match(line)
+        if match:
+            times[match.group(4)] = int(match.group(2))
+    return times
+
+def bench_imports(modules: typing.List[str], repeat: int) -> typing.Dict[str, dict]:
+    results: typing.Dict[str, dict] = dict()
+    for module in modules:
+        runs = [measure_import_time(module) for _ in range(repeat)]
+        best = min(runs, key=lambda times: times[module])
+        results[module] = {
+            'import_time_us': best[module],
+            'imported_modules': sorted(best.keys()),
+        }
+    return results
+
+def find_documents(paths: typing.List[str]) -> typing.List[str]:
+    """Get the BYML files (possibly Yaz0 compressed) in a list of files and directories."""
+    candidates: typing.List[str] = []
+    for path in paths:
+        if os.path.isdir(path):
+            for (dirpath, _, filenames) in os.walk(path):
+                candidates.extend(os.path.join(dirpath, name) for name in sorted(filenames))
+        else:
+            candidates.append(path)
+    documents: typing.List[str] = []
+    for path in candidates:
+        with open(path, 'rb') as file:
+            magic = file.read(4)
+        if magic[0:2] in (b'BY', b'YB') or magic == b'Yaz0':
+            documents.append(path)
+    return documents
+
+def _time_best(function: typing.Callable[[], typing.Any], repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def _measure_memory(function: typing.Callable[[], typing.Any]) -> typing.Tuple[int, int]:
+    """Run a function with tracemalloc and get its peak memory usage (in bytes) and the number of
+    memory blocks that it allocated and that are still alive when it returns (i.e. its result)."""
+    import tracemalloc
+    # Only allocations made after tracing starts are traced.
+    tracemalloc.start()
+    try:
+        result = function()
+        peak = tracemalloc.get_traced_memory()[1]
+        blocks = len(tracemalloc.take_snapshot().traces)
+        del result
+    finally:
+        tracemalloc.stop()
+    return (peak, blocks)
+
+def bench_document(path: str, repeat: int, memory: bool = True) -> dict:
+    """Measure parse, write, YAML emit and YAML load times for a BYML file.
+
+    Throughputs are relative to the size of the BYML document for parse and write and to the size of
+    the YAML document for emit and load."""
+    from . import byml
+    from . import byml_to_yml
+    from . import yaz0
+    from . import yml_to_byml
+
+    with open(path, 'rb') as file:
+        data = file.read()
+    compressed_size = None
+    if yaz0.is_compressed(data):
+        compressed_size = len(data)
+        data = bytes(yaz0.decompress(data))
+    result: typing.Dict[str, typing.Any] = {'path': path, 'size': len(data), 'compressed_size': compressed_size, 'nodes': 0, 'phases': {}}
+    root = byml.Byml(data).parse()
+    if root is None:
+        return result
+    be = data[0:2] == b'BY'
+    version = struct.unpack_from('>H' if be else '<H', data, 2)[0]
+    yml_data = byml_to_yml.dumps_yml(root)
+    stats = byml.Stats()
+    stats.count_nodes(root)
+    nodes = sum(stats.node_counts.values())
+
+    phases: typing.Dict[str, typing.Tuple[typing.Callable[[], typing.Any], int]] = {
+        'parse': (lambda: byml.Byml(data).parse(), len(data)),
+        'write': (lambda: byml.Writer(root, be=be, version=version).get_bytes(), len(data)),
+        'emit': (lambda: byml_to_yml.dumps_yml(root), len(yml_data)),
+        'load': (lambda: yml_to_byml.make_writer(yml_data, be, version), len(yml_data)),
+    }
+    results: typing.Dict[str, dict] = result['phases']
+    for (name, (function, size)) in phases.items():
+        seconds = _time_best(function, repeat)
+        results[name] = {
+            'seconds': seconds,
+            'bytes': size,
+            'mb_per_s': size / 1e6 / seconds,
+            'nodes_per_s': nodes / seconds,
+        }
+        if memory:
+            (results[name]['peak_memory'], results[name]['allocated_blocks']) = _measure_memory(function)
+    result['nodes'] = nodes
+    return result
+
+def bench_documents(paths: typing.List[str], repeat: int, memory: bool = True) -> typing.List[dict]:
+    return [bench_document(path, repeat, memory) for path in find_documents(paths)]
+
+def _print_document_results(results: typing.List[dict]) -> None:
+    for result in results:
+        print('%s (%u bytes, %u nodes)' % (result['path'], result['size'], result['nodes']))
+        for (name, phase) in result['phases'].items():
+            line = '  %-6s %9.2f ms %9.2f MB/s %12.0f nodes/s' % (name, phase['seconds'] * 1000, phase['mb_per_s'],
+                                                               phase['nodes_per_s'])
+            if 'peak_memory' in phase:
+                line += '  peak %8.2f MB  %9u blocks' % (phase['peak_memory'] / 1e6, phase['allocated_blocks'])
+            print(line)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmarks for the byml package.')
+    parser.add_argument('documents', nargs='*', metavar='PATH',
+                        help='BYML files or directories to benchmark parsing, writing, YAML emitting and YAML loading with '
+                             '(default: test_data)')
+    parser.add_argument('--imports', nargs='*', metavar='MODULE', help='Modules whose import time should be measured (default: %s)' % ' '.join(IMPORT_TIME_MODULES))
+    parser.add_argument('--only', choices=['imports', 'documents'], help='Only run one kind of benchmark')
+    parser.add_argument('--no-memory', action='store_true', help='Do not measure peak memory usage and allocations (faster)')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='Number of runs; the fastest one is reported')
+    parser.add_argument('--json', action='store_true', help='Output results as JSON')
+    args = parser.parse_args()
+
+    results: typing.Dict[str, typing.Any] = dict()
+    if args.only != 'documents':
+        results['imports'] = bench_imports(args.imports or IMPORT_TIME_MODULES, args.repeat)
+    if args.only != 'imports' and (args.documents or os.path.isdir(DEFAULT_DOCUMENT_DIR)):
+        results['documents'] = bench_documents(args.documents or [DEFAULT_DOCUMENT_DIR], args.repeat,
+                                               memory=not args.no_memory)
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+        return
+    for (module, result) in results.get('imports', {}).items():
+        heavy = [name for name in ('yaml', 'oead') if name in result['imported_modules']]
+        print('%-20s %8.1f ms  %s' % (module, result['import_time_us'] / 1000, ' '.join('+' + name for name in heavy)))
+    _print_document_results(results.get('documents', []))
+
+if __name__ == '__main__':
+    main()
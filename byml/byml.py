@@ -1,9 +1,17 @@
 # Copyright 2018 leoetlino <leo@leolam.fr>
 # Licensed under GPLv2+
 from enum import IntEnum
-from sortedcontainers import SortedDict # type: ignore
-import io
+import array
+import collections.abc
+import functools
+import itertools
+import mmap
+import os
+import re
 import struct
+import sys
+import time
+import types
 import typing
 
 class NodeType(IntEnum):
@@ -21,7 +29,19 @@ class NodeType(IntEnum):
     DOUBLE = 0xd6
     NULL = 0xff
 
+class EventType(IntEnum):
+    """Types of the events generated by Byml.iter_events()."""
+    START_ARRAY = 0
+    END_ARRAY = 1
+    START_HASH = 2
+    END_HASH = 3
+    KEY = 4
+    VALUE = 5
+
 _NUL_CHAR = b'\x00'
+_NUL_CHAR_RE = re.compile(_NUL_CHAR)
+# Matches runs of identical bytes, i.e. runs of same-typed nodes in an array type list.
+_NODE_TYPE_RUN_RE = re.compile(b'(.)\\1*', re.DOTALL)
 
 def _get_unpack_endian_character(big_endian: bool):
     return '>' if big_endian else '<'
@@ -29,11 +49,18 @@ def _get_unpack_endian_character(big_endian: bool):
 def _align_up(value: int, size: int) -> int:
     return value + (size - value % size) % size
 
+_NATIVE_BIG_ENDIAN = sys.byteorder == 'big'
+
+_CONTAINER_NODE_TYPES = frozenset((int(NodeType.ARRAY), int(NodeType.HASH)))
+
 def _is_container_type(node_type: int) -> bool:
     return node_type == NodeType.ARRAY or node_type == NodeType.HASH
 
+_VALUE_NODE_TYPES = frozenset(int(t) for t in (NodeType.STRING, NodeType.BOOL, NodeType.INT, NodeType.FLOAT,
+                                               NodeType.UINT, NodeType.NULL))
+
 def _is_value_type(node_type: NodeType) -> bool:
-    return node_type == NodeType.STRING or (NodeType.BOOL <= node_type <= NodeType.UINT) or node_type == NodeType.NULL
+    return node_type in _VALUE_NODE_TYPES
 
 # Nintendo uses uint nodes for some crc32 hashes. The problem is that they seem to be using
 # uints randomly and the signed getters in their byml library will not look at uint nodes.
@@ -52,13 +79,192 @@ class UInt64(int):
 class Double(float):
     pass
 
+class TypedArray(array.array):
+    """Compact array of same-typed numeric nodes (see Byml's typed_arrays option).
+
+    Items are stored as raw machine values in native byte order, so indexing or iterating gives
+    plain ints and floats; node_type (and item_type, the class used for standalone nodes of that
+    type) tells which BYML type they have. Writer serializes these arrays as is.
+    """
+    node_type: NodeType
+    item_type: type
+    _typecode: str
+
+    def __new__(cls, values=()):
+        return super().__new__(cls, cls._typecode, values)
+
+    def __copy__(self):
+        return type(self)(self)
+
+    def __deepcopy__(self, memo):
+        return type(self)(self)
+
+    def __repr__(self) -> str:
+        return '%s(%r)' % (type(self).__name__, self.tolist())
+
+class IntArray(TypedArray):
+    node_type = NodeType.INT
+    item_type = Int
+    _typecode = 'i'
+class FloatArray(TypedArray):
+    node_type = NodeType.FLOAT
+    item_type = Float
+    _typecode = 'f'
+class UIntArray(TypedArray):
+    node_type = NodeType.UINT
+    item_type = UInt
+    _typecode = 'I'
+
+class _ReadOnlyTypedArray:
+    """Typed arrays returned by Byml when share_nodes and immutable_nodes are set: since they can be
+    shared by several references, methods that would modify them raise TypeError."""
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("%s objects are read-only" % type(self).__name__)
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+    append = byteswap = extend = frombytes = fromfile = fromlist = fromunicode = _read_only
+    insert = pop = remove = reverse = _read_only
+
+class _ReadOnlyIntArray(_ReadOnlyTypedArray, IntArray):
+    pass
+class _ReadOnlyFloatArray(_ReadOnlyTypedArray, FloatArray):
+    pass
+class _ReadOnlyUIntArray(_ReadOnlyTypedArray, UIntArray):
+    pass
+
+_TYPED_ARRAY_CLASSES: typing.Dict[int, typing.Type[TypedArray]] = {
+    cls.node_type: cls for cls in (IntArray, FloatArray, UIntArray)}
+_READ_ONLY_TYPED_ARRAY_CLASSES: typing.Dict[int, typing.Type[TypedArray]] = {
+    cls.node_type: cls for cls in (_ReadOnlyIntArray, _ReadOnlyFloatArray, _ReadOnlyUIntArray)}
+
+class Stats:
+    """Statistics about a document, collected by Byml and Writer when they are created with stats=True.
+
+    node_counts is the number of nodes of each type in the document tree (nodes that are referenced
+    several times are counted once per reference). Sizes are in bytes and timings are in seconds.
+    """
+
+    def __init__(self) -> None:
+        self.node_counts: typing.Dict[NodeType, int] = dict()
+        self.document_size = 0
+        self.hash_key_count = 0
+        self.hash_key_table_size = 0
+        self.string_count = 0
+        self.string_table_size = 0
+        self.timings: typing.Dict[str, float] = dict()
+
+    def count_nodes(self, root) -> None:
+        counts: typing.Dict[NodeType, int] = collections.Counter()
+        containers = [root]
+        while containers:
+            container = containers.pop()
+            if isinstance(container, TypedArray):
+                counts[NodeType.ARRAY] += 1
+                counts[container.node_type] += len(container)
+                continue
+            if isinstance(container, collections.abc.Mapping):
+                counts[NodeType.HASH] += 1
+                values: typing.Iterable = container.values()
+            else:
+                counts[NodeType.ARRAY] += 1
+                values = container
+            for value in values:
+                node_type = _get_node_type(value)
+                if node_type == NodeType.ARRAY or node_type == NodeType.HASH:
+                    containers.append(value)
+                else:
+                    counts[node_type] += 1
+        self.node_counts = dict(counts)
+
+    def to_dict(self) -> dict:
+        result = dict(vars(self))
+        result['node_counts'] = {node_type.name.lower(): count for (node_type, count) in self.node_counts.items()}
+        return result
+
+    def format(self) -> str:
+        lines = [
+            'document: %u bytes, %u nodes (%s)' % (self.document_size, sum(self.node_counts.values()),
+                                                   ', '.join('%s: %u' % (node_type.name.lower(), count)
+                                                             for (node_type, count) in sorted(self.node_counts.items()))),
+            'hash key table: %u keys, %u bytes' % (self.hash_key_count, self.hash_key_table_size),
+            'string table: %u strings, %u bytes' % (self.string_count, self.string_table_size),
+        ]
+        lines.extend(self._format_extra())
+        lines.append('time: %s' % ', '.join('%s %.3f ms' % (phase, seconds * 1000)
+                                            for (phase, seconds) in self.timings.items()))
+        return '\n'.join(lines)
+
+    def _format_extra(self) -> typing.List[str]:
+        return []
+
+    def __str__(self) -> str:
+        return self.format()
+
+class ParseStats(Stats):
+    """Statistics collected by Byml (see Stats). They are updated by parse() and parse_iterative().
+
+    Timings: tables (reading the header and the string tables), strings (decoding the string tables)
+    and nodes (parsing the node tree).
+    """
+
+class WriteStats(Stats):
+    """Statistics collected by Writer (see Stats). They are updated every time a document is written.
+
+    written_nodes and reused_nodes are the number of non-value nodes (arrays, hashes, binary data and
+    64-bit values) that were written and the number of references to such nodes that reuse an identical
+    node instead. Timings: string_tables (collecting, sorting and writing strings), layout (assigning
+    offsets to nodes) and nodes (writing them).
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.written_nodes = 0
+        self.reused_nodes = 0
+
+    def _format_extra(self) -> typing.List[str]:
+        return ['non-value nodes: %u written, %u reused' % (self.written_nodes, self.reused_nodes)]
+
 class Byml:
-    """A simple BYMLv2 parser that handles both big endian and little endian documents."""
+    """A simple BYMLv2 parser that handles both big endian and little endian documents.
+
+    data can be any buffer (bytes, mmap, memoryview...); it is not copied. If binary_as_memoryview
+    is true, binary nodes are returned as memoryview slices of data instead of bytes.
+
+    If share_nodes is true, arrays and hashes that are referenced several times in the document
+    are only parsed once and the same object is returned for every reference. Because modifying
+    such an object would affect all of its references, immutable_nodes can be used to get arrays
+    as tuples and hashes as read-only mappings instead.
+
+    If typed_arrays is true, non-empty arrays whose items are all Int, UInt or Float nodes are returned
+    as IntArray, UIntArray or FloatArray objects, which store 4 bytes per item instead of a full
+    Python object. With share_nodes and immutable_nodes, they cannot be modified (methods that would
+    modify them raise TypeError).
 
-    def __init__(self, data: bytes) -> None:
+    If stats is true, statistics about the document are collected in self.stats (see ParseStats).
+    """
+
+    def __init__(self, data: typing.Union[bytes, bytearray, memoryview, mmap.mmap], binary_as_memoryview=False,
+                 share_nodes=False, immutable_nodes=False, typed_arrays=False, stats=False) -> None:
+        start = time.perf_counter()
+        self.stats: typing.Optional[ParseStats] = ParseStats() if stats else None
+        if isinstance(data, memoryview):
+            data = data.cast('B')
         self._data = data
+        self._binary_as_memoryview = binary_as_memoryview
+        self._share_nodes = share_nodes
+        self._immutable_nodes = immutable_nodes
+        self._typed_arrays = typed_arrays
+        # Array classes for the node types that can be stored in typed arrays (empty if disabled).
+        self._typed_array_classes: typing.Dict[int, typing.Type[TypedArray]] = {}
+        if typed_arrays:
+            self._typed_array_classes = (_READ_ONLY_TYPED_ARRAY_CLASSES if share_nodes and immutable_nodes
+                                         else _TYPED_ARRAY_CLASSES)
+        # Path of the file that data was mapped from, if any (see from_path).
+        self._path: typing.Optional[str] = None
+        self._node_cache: typing.Dict[int, typing.Any] = dict()
 
-        magic = self._data[0:2]
+        magic = bytes(self._data[0:2])
         if magic == b'BY':
             self._be = True
         elif magic == b'YB':
@@ -66,6 +272,51 @@ class Byml:
         else:
             raise ValueError("Invalid magic: %s (expected 'BY' or 'YB')" % magic)
 
+        # Select the unpackers once instead of building a format string for every read.
+        endian = _get_unpack_endian_character(self._be)
+        self._unpack_u16 = struct.Struct(endian + 'H').unpack_from
+        self._unpack_u32 = struct.Struct(endian + 'I').unpack_from
+        self._unpack_s32 = struct.Struct(endian + 'i').unpack_from
+        self._unpack_f32 = struct.Struct(endian + 'f').unpack_from
+        self._unpack_u64 = struct.Struct(endian + 'Q').unpack_from
+        self._unpack_s64 = struct.Struct(endian + 'q').unpack_from
+        self._unpack_f64 = struct.Struct(endian + 'd').unpack_from
+        # A u24 is read as the u32 that ends at the same place: the extra leading byte is
+        # the least significant one in little endian and the most significant one in big endian.
+        # u24s are never at the start of a document, so reading one byte earlier is always safe.
+        self._u24_shift = 0 if self._be else 8
+
+        # (parser, whether the value slot holds an offset to the actual data)
+        self._node_parsers: typing.Dict[int, typing.Tuple[typing.Callable[[int], typing.Any], bool]] = {
+            NodeType.STRING: (self._parse_string_node, True),
+            NodeType.BINARY: (self._parse_binary_node, True),
+            NodeType.ARRAY: (self._parse_array_node, True),
+            NodeType.HASH: (self._parse_hash_node, True),
+            NodeType.BOOL: (self._parse_bool_node, False),
+            NodeType.INT: (self._parse_int_node, False),
+            NodeType.FLOAT: (self._parse_float_node, False),
+            NodeType.UINT: (self._parse_uint_node, False),
+            NodeType.INT64: (self._parse_int64_node, True),
+            NodeType.UINT64: (self._parse_uint64_node, True),
+            NodeType.DOUBLE: (self._parse_double_node, True),
+            NodeType.NULL: (self._parse_null_node, False),
+        }
+        if share_nodes:
+            for node_type in (NodeType.ARRAY, NodeType.HASH):
+                parser, indirect = self._node_parsers[node_type]
+                self._node_parsers[node_type] = (functools.partial(self._parse_shared_node, parser), indirect)
+        self._hash_entries_format = endian + '%dQ'
+        self._hash_entry_shifts = (40, 32) if self._be else (0, 24)
+        # Value nodes that are stored inline in a 4-byte slot can be unpacked in batches.
+        # (format with a placeholder for the count, conversion for each unpacked value)
+        self._value_run_decoders: typing.Dict[int, typing.Tuple[str, typing.Callable[[typing.Any], typing.Any]]] = {
+            NodeType.STRING: (endian + '%dI', self._parse_string_node),
+            NodeType.BOOL: (endian + '%dI', bool),
+            NodeType.INT: (endian + '%di', Int),
+            NodeType.FLOAT: (endian + '%df', Float),
+            NodeType.UINT: (endian + '%dI', UInt),
+        }
+
         version = self._read_u16(2)
         if not (1 <= version <= 7):
             raise ValueError("Invalid version: %u (expected 1-7)" % version)
@@ -75,160 +326,743 @@ class Byml:
         self._hash_key_table_offset = self._read_u32(4)
         self._string_table_offset = self._read_u32(8)
 
+        self._hash_key_table = _StringTable(self._data, 0, ())
+        self._string_table = _StringTable(self._data, 0, ())
         if self._hash_key_table_offset != 0:
             self._hash_key_table = self._parse_string_table(self._hash_key_table_offset)
         if self._string_table_offset != 0:
             self._string_table = self._parse_string_table(self._string_table_offset)
+        # Decoded strings (or None for strings that have not been used yet), for the string node parser.
+        self._strings = self._string_table.strings
+
+        if self.stats is not None:
+            self.stats.document_size = len(self._data)
+            self.stats.hash_key_count = len(self._hash_key_table)
+            self.stats.hash_key_table_size = self._get_string_table_size(self._hash_key_table_offset)
+            self.stats.string_count = len(self._string_table)
+            self.stats.string_table_size = self._get_string_table_size(self._string_table_offset)
+            self.stats.timings['tables'] = time.perf_counter() - start
+
+    @classmethod
+    def from_path(cls, path: typing.Union[str, os.PathLike], **kwargs) -> 'Byml':
+        """Create a parser for a file that is memory-mapped instead of being read into memory."""
+        with open(path, 'rb') as file:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        parser = cls(data, **kwargs)
+        parser._path = os.fspath(path)
+        return parser
 
     def parse(self) -> typing.Union[list, dict, None]:
         """Parse the BYML and get the root node with all children."""
+        node_type = self._get_root_node_type()
+        if node_type is None:
+            return None
+        self._node_cache.clear()
+        return self._parse_root(self._parse_node, node_type)
+
+    def parse_iterative(self) -> typing.Union[list, dict, None]:
+        """Same as parse(), but nested containers are walked with an explicit stack instead of
+        recursion, so arbitrarily deep documents do not hit the recursion limit."""
+        node_type = self._get_root_node_type()
+        if node_type is None:
+            return None
+        self._node_cache.clear()
+        return self._parse_root(self._parse_node_iterative, node_type)
+
+    def parse_parallel(self, workers: typing.Optional[int] = None) -> typing.Union[list, dict, None]:
+        """Same as parse(), but subtrees are parsed in a pool of worker processes.
+
+        This is only worth it for large documents. The workers memory-map the document rather than
+        receiving a copy of it: the file is mapped directly if the parser was created with from_path,
+        otherwise the document is written to a temporary file first. Only the parsed subtrees are
+        sent back. Binary nodes are always returned as bytes (binary_as_memoryview is ignored) and
+        share_nodes is not supported.
+        """
+        if self._share_nodes:
+            raise ValueError("parse_parallel does not support share_nodes")
+        node_type = self._get_root_node_type()
+        if node_type is None:
+            return None
+        self._decode_string_tables()
+        if workers is None:
+            workers = os.cpu_count() or 1
+
+        # Workers return binary nodes as bytes, so the nodes that are parsed here must be bytes too.
+        binary_as_memoryview = self._binary_as_memoryview
+        self._binary_as_memoryview = False
+        try:
+            # Split the document into subtrees. Containers close to the root are created here and their
+            # children become separate subtrees, until there are enough of them to keep all workers busy
+            # (documents often have a root hash with only a few huge arrays).
+            root: list = [None]
+            # (parent container, key or index in the parent, node type, value offset)
+            subtrees: typing.List[typing.Tuple[typing.Any, typing.Any, int, int]] = [(root, 0, node_type, 12)]
+            while subtrees and len(subtrees) < 4 * workers:
+                next_subtrees = []
+                for (parent, slot, child_type, offset) in subtrees:
+                    node, children = self._begin_container(child_type, self._read_u32(offset))
+                    parent[slot] = node
+                    if children is None:
+                        continue
+                    for (i, (key, grandchild_type, grandchild_offset)) in enumerate(children):
+                        grandchild_slot = i if key is None else key
+                        if grandchild_type in _CONTAINER_NODE_TYPES:
+                            value = None
+                            next_subtrees.append((node, grandchild_slot, grandchild_type, grandchild_offset))
+                        else:
+                            value = self._parse_node(grandchild_type, grandchild_offset)
+                        if key is None:
+                            node.append(value)
+                        else:
+                            node[key] = value
+                subtrees = next_subtrees
+        finally:
+            self._binary_as_memoryview = binary_as_memoryview
+        if not subtrees:
+            return root[0]
+
+        import concurrent.futures
+        import tempfile
+        path = self._path
+        if path is None:
+            with tempfile.NamedTemporaryFile(prefix='byml', delete=False) as file:
+                file.write(self._data)
+            path = file.name
+        try:
+            chunk_size = -(-len(subtrees) // (4 * workers))
+            chunks = [subtrees[i:i + chunk_size] for i in range(0, len(subtrees), chunk_size)]
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                results = executor.map(functools.partial(_parse_subtrees, path, self._typed_arrays),
+                                       [[(node_type, offset) for (_, _, node_type, offset) in chunk] for chunk in chunks])
+                for (chunk, values) in zip(chunks, results):
+                    for ((parent, slot, _, _), value) in zip(chunk, values):
+                        parent[slot] = value
+        finally:
+            if path is not self._path:
+                os.unlink(path)
+        return root[0]
+
+    def parse_lazy(self) -> typing.Union['LazyArray', 'LazyHash', None]:
+        """Get the root node as a read-only proxy. Children are only parsed when accessed."""
+        node_type = self._get_root_node_type()
+        if node_type is None:
+            return None
+        return self._parse_lazy_node(node_type, 12)
+
+    def get(self, path: typing.Union[str, typing.Sequence[typing.Union[str, int]]], default=None):
+        """Get a single node without parsing the rest of the document.
+
+        path is either a sequence of hash keys and array indices or a string where they are separated
+        by slashes (e.g. "Objs/12/UnitConfigName"). Returns default if there is no such node.
+        """
+        if isinstance(path, str):
+            path = path.split('/') if path else []
+
+        node_type = self._get_root_node_type()
+        if node_type is None:
+            return default
+
+        # Offset of the reference to (or the value of) the current node.
+        offset = 12
+        for component in path:
+            if node_type == NodeType.ARRAY:
+                item = self._find_array_item(self._read_u32(offset), component)
+            elif node_type == NodeType.HASH:
+                item = self._find_hash_item(self._read_u32(offset), component)
+            else:
+                return default
+            if item is None:
+                return default
+            node_type, offset = item
+        self._node_cache.clear()
+        if _is_container_type(node_type):
+            self._hash_key_table.decode_all()
+        return self._parse_node(node_type, offset)
+
+    def _find_array_item(self, offset: int, index: typing.Union[str, int]) -> typing.Optional[typing.Tuple[int, int]]:
+        """Get the node type and value offset of an array item."""
+        try:
+            index = int(index)
+        except ValueError:
+            return None
+        size = self._read_u24(offset + 1)
+        if index < 0:
+            index += size
+        if not (0 <= index < size):
+            return None
+        return (self._data[offset + 4 + index], offset + _align_up(size, 4) + 4 + 4*index)
+
+    def _find_hash_item(self, offset: int, key: typing.Union[str, int]) -> typing.Optional[typing.Tuple[int, int]]:
+        """Get the node type and value offset of a hash item."""
+        # Both the hash key table and hash entries are sorted, so the key index and then the entry
+        # can be found with a binary search.
+        key_index = self._hash_key_table.find(key) if isinstance(key, str) else None
+        if key_index is None:
+            return None
+        low = 0
+        high = self._read_u24(offset + 1)
+        while low < high:
+            middle = (low + high) // 2
+            entry_offset = offset + 4 + 8*middle
+            entry_key_index = self._read_u24(entry_offset)
+            if entry_key_index < key_index:
+                low = middle + 1
+            elif entry_key_index > key_index:
+                high = middle
+            else:
+                return (self._data[entry_offset + 3], entry_offset + 4)
+        return None
+
+    def iter_events(self) -> typing.Iterator[typing.Tuple[EventType, typing.Any]]:
+        """Walk the document without building any container and generate (event type, value) tuples
+        in document order.
+
+        START_ARRAY and START_HASH events carry the number of items in the container, KEY events carry
+        the key of the next hash item and VALUE events carry a parsed value node. END_ARRAY and
+        END_HASH events carry None. Nothing is generated for an empty document.
+        """
+        node_type = self._get_root_node_type()
+        if node_type is None:
+            return
+        self._decode_string_tables()
+        # Each frame is (iterator over the (key, node type, value offset) children of a container,
+        # end event, node offset). Keys are None for array items. The bottom frame only holds the root node.
+        stack: list = [(iter([(None, node_type, 12)]), None, None)]
+        # Offsets of the containers on the stack (see _parse_node_iterative).
+        open_offsets: typing.Set[int] = set()
+        container_types = _CONTAINER_NODE_TYPES
+        while stack:
+            children, parent_end_event, parent_offset = stack[-1]
+            for (key, child_type, child_offset) in children:
+                if key is not None:
+                    yield (EventType.KEY, key)
+                if child_type not in container_types:
+                    yield (EventType.VALUE, self._parse_node(child_type, child_offset))
+                    continue
+
+                node_offset = self._read_u32(child_offset)
+                container, grandchildren = self._begin_container(child_type, node_offset)
+                if child_type == NodeType.ARRAY:
+                    start_event, end_event = (EventType.START_ARRAY, (EventType.END_ARRAY, None))
+                else:
+                    start_event, end_event = (EventType.START_HASH, (EventType.END_HASH, None))
+                if grandchildren is not None:
+                    self._open_container(open_offsets, node_offset)
+                    yield (start_event, len(grandchildren))
+                    stack.append((iter(grandchildren), end_event, node_offset))
+                    break
+                # Containers without nested containers are parsed in one go with the batched value decoders.
+                yield (start_event, len(container))
+                if isinstance(container, dict):
+                    for (key, value) in container.items():
+                        yield (EventType.KEY, key)
+                        yield (EventType.VALUE, value)
+                else:
+                    if isinstance(container, TypedArray):
+                        container = map(container.item_type, container)
+                    yield from zip(itertools.repeat(EventType.VALUE), container)
+                yield end_event
+            else:
+                stack.pop()
+                open_offsets.discard(parent_offset)
+                if parent_end_event is not None:
+                    yield parent_end_event
+
+    def _get_root_node_type(self) -> typing.Optional[int]:
+        """Get the type of the root node, or None if the document is empty."""
         root_node_offset = self._read_u32(12)
         if root_node_offset == 0:
             return None
-
         node_type = self._data[root_node_offset]
         if not _is_container_type(node_type):
             raise ValueError("Invalid root node: expected array or dict, got type 0x%x" % node_type)
-        return self._parse_node(node_type, 12)
+        return node_type
+
+    def _parse_root(self, parse_node: typing.Callable[[int, int], typing.Any], node_type: int):
+        if self.stats is None:
+            self._decode_string_tables()
+            return parse_node(node_type, 12)
+        start = time.perf_counter()
+        self._decode_string_tables()
+        strings_decoded = time.perf_counter()
+        root = parse_node(node_type, 12)
+        self.stats.timings['strings'] = strings_decoded - start
+        self.stats.timings['nodes'] = time.perf_counter() - strings_decoded
+        self.stats.count_nodes(root)
+        return root
+
+    def _decode_string_tables(self) -> None:
+        # For methods that walk the whole document and are going to need most strings anyway.
+        self._hash_key_table.decode_all()
+        self._string_table.decode_all()
+
+    def _parse_lazy_node(self, node_type: int, offset: int):
+        if node_type == NodeType.ARRAY:
+            return LazyArray(self, self._read_u32(offset))
+        if node_type == NodeType.HASH:
+            return LazyHash(self, self._read_u32(offset))
+        return self._parse_node(node_type, offset)
+
+    def _get_string_table_size(self, offset: int) -> int:
+        if offset == 0:
+            return 0
+        # The offset after the last string is the size of the table.
+        return self._read_u32(offset + 4 + 4*self._read_u24(offset + 1))
 
-    def _parse_string_table(self, offset) -> typing.List[str]:
+    def _parse_string_table(self, offset) -> '_StringTable':
         if self._data[offset] != NodeType.STRING_TABLE:
             raise ValueError("Invalid node type: 0x%x (expected 0xc2)" % self._data[offset])
 
-        array = list()
         size = self._read_u24(offset + 1)
-        for i in range(size):
-            string_offset = offset + self._read_u32(offset + 4 + 4*i)
-            array.append(self._read_string(string_offset))
-        return array
+        string_offsets = struct.unpack_from(_get_unpack_endian_character(self._be) + '%dI' % size,
+                                            self._data, offset + 4)
+        return _StringTable(self._data, offset, string_offsets)
 
     def _parse_node(self, node_type: int, offset: int):
-        if node_type == NodeType.STRING:
-            return self._parse_string_node(self._read_u32(offset))
-        if node_type == NodeType.BINARY:
-            return self._parse_binary_node(self._read_u32(offset))
+        try:
+            parser, indirect = self._node_parsers[node_type]
+        except KeyError:
+            raise ValueError("Unknown node type: 0x%x" % node_type) from None
+        if indirect:
+            offset = self._unpack_u32(self._data, offset)[0]
+        return parser(offset)
+
+    def _parse_node_iterative(self, node_type: int, offset: int):
+        # Each frame is (container being filled, iterator over its children, key in the parent
+        # container, node offset). Children are (key, node type, value offset) tuples; the key
+        # is None for array items. The bottom frame only collects the result.
+        result: list = list()
+        stack = [(result, iter([(None, node_type, offset)]), None, None)]
+        # Offsets of the containers on the stack. A container that references one of them would make
+        # the stack grow forever.
+        open_offsets: typing.Set[int] = set()
+        container_types = _CONTAINER_NODE_TYPES
+        while True:
+            container, children, key, node_offset = stack[-1]
+            for (child_key, child_type, child_offset) in children:
+                if child_type in container_types:
+                    child_node_offset = self._read_u32(child_offset)
+                    try:
+                        value = self._node_cache[child_node_offset]
+                    except KeyError:
+                        value, grandchildren = self._begin_container(child_type, child_node_offset)
+                        if grandchildren is not None:
+                            self._open_container(open_offsets, child_node_offset)
+                            stack.append((value, iter(grandchildren), child_key, child_node_offset))
+                            break
+                        if self._share_nodes:
+                            value = self._share_node(child_node_offset, value)
+                else:
+                    value = self._parse_node(child_type, child_offset)
+                if child_key is None:
+                    container.append(value)
+                else:
+                    container[child_key] = value
+            else:
+                stack.pop()
+                if node_offset is None:
+                    return result[0]
+                open_offsets.discard(node_offset)
+                if self._share_nodes:
+                    container = self._share_node(node_offset, container)
+                parent = stack[-1][0]
+                if key is None:
+                    parent.append(container)
+                else:
+                    parent[key] = container
+
+    @staticmethod
+    def _open_container(open_offsets: typing.Set[int], offset: int) -> None:
+        """Record that a container is being walked, and check that it is not already (i.e. that it does
+        not contain itself)."""
+        if offset in open_offsets:
+            raise ValueError("Invalid container at offset 0x%x: it contains itself" % offset)
+        open_offsets.add(offset)
+
+    def _begin_container(self, node_type: int, offset: int) -> typing.Tuple[typing.Any, typing.Optional[list]]:
+        """Parse a container that has no nested containers, or get an empty container and its
+        (key, node type, value offset) children otherwise."""
+        size = self._read_u24(offset + 1)
         if node_type == NodeType.ARRAY:
-            return self._parse_array_node(self._read_u32(offset))
-        if node_type == NodeType.HASH:
-            return self._parse_hash_node(self._read_u32(offset))
-        if node_type == NodeType.BOOL:
-            return self._parse_bool_node(offset)
-        if node_type == NodeType.INT:
-            return self._parse_int_node(offset)
-        if node_type == NodeType.FLOAT:
-            return self._parse_float_node(offset)
-        if node_type == NodeType.UINT:
-            return self._parse_uint_node(offset)
-        if node_type == NodeType.INT64:
-            return self._parse_int64_node(self._read_u32(offset))
-        if node_type == NodeType.UINT64:
-            return self._parse_uint64_node(self._read_u32(offset))
-        if node_type == NodeType.DOUBLE:
-            return self._parse_double_node(self._read_u32(offset))
-        if node_type == NodeType.NULL:
-            return None
-        raise ValueError("Unknown node type: 0x%x" % node_type)
+            node_types = bytes(self._data[offset + 4:offset + 4 + size])
+            if _CONTAINER_NODE_TYPES.isdisjoint(node_types):
+                return (self._parse_array_node(offset), None)
+            value_array_offset = offset + _align_up(size, 4) + 4
+            return (list(), list(zip(itertools.repeat(None), node_types,
+                                     range(value_array_offset, value_array_offset + 4*size, 4))))
+
+        entries = struct.unpack_from(self._hash_entries_format % size, self._data, offset + 4)
+        key_shift, type_shift = self._hash_entry_shifts
+        hash_keys = self._hash_key_table.strings
+        keys = [hash_keys[(entry >> key_shift) & 0xffffff] for entry in entries]
+        hash_node_types = [(entry >> type_shift) & 0xff for entry in entries]
+        value_offsets = range(offset + 8, offset + 8 + 8*size, 8)
+        if _CONTAINER_NODE_TYPES.isdisjoint(hash_node_types):
+            return (dict(zip(keys, map(self._parse_node, hash_node_types, value_offsets))), None)
+        return (dict(), list(zip(keys, hash_node_types, value_offsets)))
+
+    def _parse_shared_node(self, parser: typing.Callable[[int], typing.Any], offset: int):
+        try:
+            return self._node_cache[offset]
+        except KeyError:
+            pass
+        return self._share_node(offset, parser(offset))
+
+    def _share_node(self, offset: int, node):
+        if self._immutable_nodes:
+            if isinstance(node, list):
+                node = tuple(node)
+            elif isinstance(node, dict):
+                node = types.MappingProxyType(node)
+        self._node_cache[offset] = node
+        return node
 
     def _parse_string_node(self, index: int) -> str:
-        return self._string_table[index]
+        string = self._strings[index]
+        if string is None:
+            string = self._string_table[index]
+        return string
 
-    def _parse_binary_node(self, offset: int) -> bytes:
+    def _parse_binary_node(self, offset: int) -> typing.Union[bytes, memoryview]:
         size = self._read_u32(offset)
-        return self._data[offset+4:offset+4+size]
+        if self._binary_as_memoryview:
+            return memoryview(self._data)[offset+4:offset+4+size]
+        return bytes(self._data[offset+4:offset+4+size])
 
-    def _parse_array_node(self, offset: int) -> list:
+    def _parse_array_node(self, offset: int) -> typing.Union[list, TypedArray]:
         size = self._read_u24(offset + 1)
-        array: list = list()
         value_array_offset: int = offset + _align_up(size, 4) + 4
-        for i in range(size):
-            node_type = self._data[offset + 4 + i]
-            array.append(self._parse_node(node_type, value_array_offset + 4*i))
+        node_types = bytes(self._data[offset + 4:offset + 4 + size])
+        if size and node_types.count(node_types[0]) == size:
+            array_class = self._typed_array_classes.get(node_types[0])
+            if array_class is not None:
+                return self._parse_typed_array(array_class, value_array_offset, size)
+            return self._parse_node_run(node_types[0], value_array_offset, size)
+        array: list = list()
+        for run in _NODE_TYPE_RUN_RE.finditer(node_types):
+            start = run.start()
+            array.extend(self._parse_node_run(node_types[start], value_array_offset + 4*start, run.end() - start))
         return array
 
+    def _parse_typed_array(self, array_class: typing.Type[TypedArray], offset: int, count: int) -> TypedArray:
+        typed_array = array_class()
+        # The array.array methods also fill read-only arrays.
+        array.array.frombytes(typed_array, self._data[offset:offset + 4*count])
+        if self._be != _NATIVE_BIG_ENDIAN:
+            array.array.byteswap(typed_array)
+        return typed_array
+
+    def _parse_node_run(self, node_type: int, offset: int, count: int) -> list:
+        """Parse count consecutive nodes of the same type whose value slots start at offset."""
+        decoder = self._value_run_decoders.get(node_type)
+        if decoder is not None and count > 1:
+            fmt, convert = decoder
+            return list(map(convert, struct.unpack_from(fmt % count, self._data, offset)))
+        return [self._parse_node(node_type, offset + 4*i) for i in range(count)]
+
     def _parse_hash_node(self, offset: int) -> dict:
         size = self._read_u24(offset + 1)
         result: dict = dict()
-        for i in range(size):
-            entry_offset: int = offset + 4 + 8*i
-            string_index: int = self._read_u24(entry_offset + 0)
-            name: str = self._hash_key_table[string_index]
-
-            node_type = self._data[entry_offset + 3]
-            result[name] = self._parse_node(node_type, entry_offset + 4)
+        # Entries (u24 key index, u8 node type, 4-byte value slot) are unpacked in one go as u64s.
+        entries = struct.unpack_from(self._hash_entries_format % size, self._data, offset + 4)
+        key_shift, type_shift = self._hash_entry_shifts
+        # Methods that parse whole containers decode the hash key table beforehand, since they are
+        # going to need most keys anyway and this keeps the per-entry lookup a plain list access.
+        hash_keys = self._hash_key_table.strings
+        for (i, entry) in enumerate(entries):
+            name: str = hash_keys[(entry >> key_shift) & 0xffffff]
+            node_type = (entry >> type_shift) & 0xff
+            result[name] = self._parse_node(node_type, offset + 8 + 8*i)
 
         return result
 
     def _parse_bool_node(self, offset: int) -> bool:
-        return self._parse_uint_node(offset) != 0
+        return self._unpack_u32(self._data, offset)[0] != 0
 
     def _parse_int_node(self, offset: int) -> Int:
-        return Int(struct.unpack_from(_get_unpack_endian_character(self._be) + 'i', self._data, offset)[0])
+        return Int(self._unpack_s32(self._data, offset)[0])
 
     def _parse_float_node(self, offset: int) -> Float:
-        return Float(struct.unpack_from(_get_unpack_endian_character(self._be) + 'f', self._data, offset)[0])
+        return Float(self._unpack_f32(self._data, offset)[0])
 
     def _parse_uint_node(self, offset: int) -> UInt:
-        return UInt(self._read_u32(offset))
+        return UInt(self._unpack_u32(self._data, offset)[0])
 
     def _parse_int64_node(self, offset: int) -> Int64:
-        return Int64(struct.unpack_from(_get_unpack_endian_character(self._be) + 'q', self._data, offset)[0])
+        return Int64(self._unpack_s64(self._data, offset)[0])
 
     def _parse_uint64_node(self, offset: int) -> UInt64:
-        return UInt64(struct.unpack_from(_get_unpack_endian_character(self._be) + 'Q', self._data, offset)[0])
+        return UInt64(self._unpack_u64(self._data, offset)[0])
 
     def _parse_double_node(self, offset: int) -> Double:
-        return Double(struct.unpack_from(_get_unpack_endian_character(self._be) + 'd', self._data, offset)[0])
+        return Double(self._unpack_f64(self._data, offset)[0])
+
+    def _parse_null_node(self, offset: int) -> None:
+        return None
 
     def _read_u16(self, offset: int) -> int:
-        return struct.unpack_from(_get_unpack_endian_character(self._be) + 'H', self._data, offset)[0]
+        return self._unpack_u16(self._data, offset)[0]
 
     def _read_u24(self, offset: int) -> int:
-        if self._be:
-            return struct.unpack('>I', _NUL_CHAR + self._data[offset:offset+3])[0]
-        return struct.unpack('<I', self._data[offset:offset+3] + _NUL_CHAR)[0]
+        return (self._unpack_u32(self._data, offset - 1)[0] >> self._u24_shift) & 0xffffff
 
     def _read_u32(self, offset: int) -> int:
-        return struct.unpack_from(_get_unpack_endian_character(self._be) + 'I', self._data, offset)[0]
+        return self._unpack_u32(self._data, offset)[0]
+
+# Parser for the document that is being parsed by Byml.parse_parallel, in worker processes. It is created
+# by the first chunk that a worker gets (ProcessPoolExecutor only has initializers since Python 3.7).
+_parallel_worker_parser: typing.Optional[typing.Tuple[str, bool, Byml]] = None
+
+def _parse_subtrees(path: str, typed_arrays: bool, subtrees: typing.List[typing.Tuple[int, int]]) -> list:
+    global _parallel_worker_parser
+    if _parallel_worker_parser is None or _parallel_worker_parser[0:2] != (path, typed_arrays):
+        parser = Byml.from_path(path, typed_arrays=typed_arrays)
+        parser._decode_string_tables()
+        _parallel_worker_parser = (path, typed_arrays, parser)
+    parser = _parallel_worker_parser[2]
+    return [parser._parse_node(node_type, offset) for (node_type, offset) in subtrees]
+
+class _StringTable:
+    """Hash key or string table. Strings are only decoded the first time they are used."""
+
+    def __init__(self, data, base: int, string_offsets: typing.Sequence[int]) -> None:
+        self._data = data
+        self._base = base
+        self._string_offsets = string_offsets
+        # Decoded strings, or None for strings that have not been used yet.
+        self.strings: typing.List[typing.Optional[str]] = [None] * len(string_offsets)
+        self._fully_decoded = not string_offsets
+
+    def __len__(self) -> int:
+        return len(self.strings)
+
+    def __getitem__(self, index: int) -> str:
+        string = self.strings[index]
+        if string is None:
+            string = self._read_string(self._base + self._string_offsets[index])
+            self.strings[index] = string
+        return string
+
+    def decode_all(self) -> typing.List[str]:
+        """Decode every string and get them as a list (for code that is going to use most of them)."""
+        if self._fully_decoded:
+            return typing.cast(typing.List[str], self.strings)
+
+        # Strings are normally stored back to back and in order, in which case they can all be
+        # decoded in one go.
+        start = self._base + self._string_offsets[0]
+        end = self._find_end(self._base + self._string_offsets[-1])
+        blob = bytes(self._data[start:end])
+        lengths = [len(string) + 1 for string in blob.split(_NUL_CHAR)]
+        if list(itertools.accumulate([self._string_offsets[0]] + lengths[:-1])) == list(self._string_offsets):
+            self.strings[:] = str(blob, 'utf-8').split('\x00')
+        else:
+            for i in range(len(self.strings)):
+                self[i]
+        self._fully_decoded = True
+        return typing.cast(typing.List[str], self.strings)
+
+    def _find_end(self, offset: int) -> int:
+        return _NUL_CHAR_RE.search(self._data, offset).end() - 1
 
     def _read_string(self, offset: int) -> str:
-        end = self._data.find(_NUL_CHAR, offset)
-        return self._data[offset:end].decode('utf-8')
-
-class _PlaceholderOffsetWriter:
-    """Writes a placeholder offset value that will be filled later."""
-    def __init__(self, stream: typing.BinaryIO, parent) -> None:
-        self._stream = stream
-        self._offset = stream.tell()
-        self._parent = parent
-    def write_placeholder(self) -> None:
-        self._stream.write(self._parent._u32(0xffffffff))
-    def write_offset(self, offset: int, base: int = 0) -> None:
-        current_offset = self._stream.tell()
-        self._stream.seek(self._offset)
-        self._stream.write(self._parent._u32(offset - base))
-        self._stream.seek(current_offset)
-    def write_current_offset(self, base: int = 0) -> None:
-        self.write_offset(self._stream.tell(), base)
+        return str(self._data[offset:self._find_end(offset)], 'utf-8')
+
+    def find(self, string: str) -> typing.Optional[int]:
+        """Get the index of a string, or None if it is not in the table.
+
+        Tables are sorted, so this only needs to decode O(log n) strings."""
+        low = 0
+        high = len(self.strings)
+        while low < high:
+            middle = (low + high) // 2
+            middle_string = self[middle]
+            if middle_string < string:
+                low = middle + 1
+            elif middle_string > string:
+                high = middle
+            else:
+                return middle
+        return None
+
+_UNPARSED = object()
+
+class LazyArray(collections.abc.Sequence):
+    """Read-only view of an array node. Items are parsed on first access and then cached."""
+
+    def __init__(self, parser: Byml, offset: int) -> None:
+        self._parser = parser
+        self._offset = offset
+        self._size = parser._read_u24(offset + 1)
+        self._value_array_offset = offset + _align_up(self._size, 4) + 4
+        self._items: typing.List[typing.Any] = [_UNPARSED] * self._size
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._size))]
+        if index < 0:
+            index += self._size
+        if not (0 <= index < self._size):
+            raise IndexError("array index out of range")
+        item = self._items[index]
+        if item is _UNPARSED:
+            node_type = self._parser._data[self._offset + 4 + index]
+            item = self._parser._parse_lazy_node(node_type, self._value_array_offset + 4*index)
+            self._items[index] = item
+        return item
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, (list, LazyArray)):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for (a, b) in zip(self, other))
+
+    def __repr__(self) -> str:
+        return 'LazyArray(size=%d)' % self._size
+
+class LazyHash(collections.abc.Mapping):
+    """Read-only view of a hash node. Values are parsed on first access and then cached."""
+
+    def __init__(self, parser: Byml, offset: int) -> None:
+        self._parser = parser
+        self._offset = offset
+        self._size = parser._read_u24(offset + 1)
+        self._entry_indices: typing.Optional[typing.Dict[str, int]] = None
+        self._values: typing.Dict[str, typing.Any] = dict()
+
+    def _get_entry_indices(self) -> typing.Dict[str, int]:
+        if self._entry_indices is None:
+            self._entry_indices = dict()
+            for i in range(self._size):
+                string_index = self._parser._read_u24(self._offset + 4 + 8*i)
+                self._entry_indices[self._parser._hash_key_table[string_index]] = i
+        return self._entry_indices
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __iter__(self):
+        return iter(self._get_entry_indices())
+
+    def __contains__(self, key) -> bool:
+        return key in self._get_entry_indices()
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        entry_offset = self._offset + 4 + 8*self._get_entry_indices()[key]
+        node_type = self._parser._data[entry_offset + 3]
+        value = self._parser._parse_lazy_node(node_type, entry_offset + 4)
+        self._values[key] = value
+        return value
+
+    def __repr__(self) -> str:
+        return 'LazyHash(size=%d)' % self._size
 
 _NodeToOffsetMap = typing.Dict[typing.Tuple[NodeType, typing.Any], int]
-def _freeze_object(o):
-    def _freeze(o):
-        if isinstance(o, dict):
-            return frozenset({ k: _freeze(v) for k,v in o.items()}.items())
-        if isinstance(o, list):
-            return tuple([_freeze(v) for v in o])
-        return o
-    return _freeze(o)
+# (node, offset, hash keys in entry order, child node types, offsets of the non-value nodes it references)
+_NodeLayout = typing.Tuple[typing.Any, int, typing.List[str], typing.List[NodeType], typing.List[int]]
+# Exact types that can be mapped to a node type without going through the isinstance checks.
+_NODE_TYPES_BY_CLASS: typing.Dict[type, NodeType] = {
+    str: NodeType.STRING, bytes: NodeType.BINARY, list: NodeType.ARRAY, dict: NodeType.HASH,
+    bool: NodeType.BOOL, Int: NodeType.INT, Float: NodeType.FLOAT, UInt: NodeType.UINT,
+    Int64: NodeType.INT64, UInt64: NodeType.UINT64, Double: NodeType.DOUBLE, type(None): NodeType.NULL,
+    IntArray: NodeType.ARRAY, FloatArray: NodeType.ARRAY, UIntArray: NodeType.ARRAY,
+    _ReadOnlyIntArray: NodeType.ARRAY, _ReadOnlyFloatArray: NodeType.ARRAY, _ReadOnlyUIntArray: NodeType.ARRAY,
+    tuple: NodeType.ARRAY, types.MappingProxyType: NodeType.HASH,
+}
+# Containers that the writer accepts (parsers can return tuples and read-only mappings, see immutable_nodes).
+_ARRAY_CLASSES = (list, tuple)
+_HASH_CLASSES = (dict, collections.abc.Mapping)
+# Containers whose values are walked when collecting strings (typed arrays hold no strings).
+_WALKED_CONTAINER_CLASSES = frozenset((list, dict, tuple, types.MappingProxyType))
+
+def _get_node_type(data) -> NodeType:
+    """Get the type of a node, for parsed documents (which may contain immutable containers, see Byml's
+    immutable_nodes option, or memoryviews) and for documents that are passed to Writer."""
+    node_type = _NODE_TYPES_BY_CLASS.get(type(data))
+    if node_type is not None:
+        return node_type
+    if isinstance(data, memoryview):
+        return NodeType.BINARY
+    if isinstance(data, collections.abc.Mapping):
+        return NodeType.HASH
+    for (cls, node_type) in _NODE_TYPES_BY_CLASS.items():
+        if isinstance(data, cls):
+            return node_type
+    if isinstance(data, int) or isinstance(data, float):
+        raise ValueError("Implicit conversions from int/float are not supported -- "
+                         "please use Int/Float/UInt/Int64/UInt64/Double")
+    raise ValueError("Invalid value type")
+
+class _SubtreeKeys:
+    """Computes keys that compare equal for equal subtrees, for reusing nodes.
+
+    Each container gets a small (node type, index) key that is interned from the keys of its
+    children, so every container is only visited once no matter how deep it is. Values are their
+    own keys (binary data is keyed by its bytes since memoryviews of writable buffers cannot be
+    hashed), which means that subtrees compare exactly like nested Python objects would.
+    """
+
+    def __init__(self) -> None:
+        self._keys_by_id: typing.Dict[int, typing.Any] = dict()
+        self._interned_keys: typing.Dict[typing.Any, typing.Tuple[NodeType, int]] = dict()
+
+    def get(self, data):
+        if isinstance(data, (list, tuple, TypedArray)):
+            node_type = NodeType.ARRAY
+        elif isinstance(data, (dict, types.MappingProxyType)):
+            node_type = NodeType.HASH
+        elif type(data) in _NODE_TYPES_BY_CLASS:
+            # Values (checked before the slower Mapping check)
+            return data
+        elif isinstance(data, memoryview):
+            return bytes(data)
+        elif isinstance(data, collections.abc.Mapping):
+            node_type = NodeType.HASH
+        else:
+            return data
+        try:
+            return self._keys_by_id[id(data)]
+        except KeyError:
+            pass
+
+        if isinstance(data, TypedArray):
+            # Type objects cannot be values, so this cannot collide with the key of a list. (item_type
+            # rather than the class, so that read-only arrays get the same keys as the others.)
+            children = (data.item_type, data.tobytes())
+        elif node_type == NodeType.ARRAY:
+            children = tuple([self.get(item) for item in data])
+        else:
+            children = tuple([(key, self.get(data[key])) for key in sorted(data.keys())])
+        key = self._interned_keys.setdefault((node_type, children), (node_type, len(self._interned_keys)))
+        self._keys_by_id[id(data)] = key
+        return key
 
 class Writer:
-    """BYMLv2 writer."""
+    """BYMLv2 writer.
 
-    def __init__(self, data: typing.Union[dict, list], be=False, version=2) -> None:
+    hash_keys and strings may be passed if the caller already knows every hash key and string value
+    in the document (e.g. because it collected them while loading it), in which case the writer
+    does not need to walk the document to build its string tables.
+
+    If stats is true, statistics about the written document are collected in self.stats (see WriteStats).
+    """
+
+    def __init__(self, data: typing.Union[dict, list, TypedArray], be=False, version=2,
+                 hash_keys: typing.Optional[typing.Iterable[str]] = None,
+                 strings: typing.Optional[typing.Iterable[str]] = None, stats=False) -> None:
+        start = time.perf_counter()
+        self.stats: typing.Optional[WriteStats] = WriteStats() if stats else None
         self._data = data
         self._be = be
         self._version = version
 
-        if not isinstance(data, list) and not isinstance(data, dict):
+        if not isinstance(data, (_ARRAY_CLASSES, TypedArray)) and not isinstance(data, _HASH_CLASSES):
             raise ValueError("Data should be a dict or a list")
 
         if not (1 <= version <= 7):
@@ -236,201 +1070,244 @@ class Writer:
         if version == 1 and be:
             raise ValueError("Invalid version: %u-wiiu (expected 1-3)" % version)
 
-        self._hash_key_table: SortedDict[str, int] = SortedDict()
-        self._string_table: SortedDict[str, int] = SortedDict()
-        self._make_string_table(self._data, self._hash_key_table, self._string_table)
+        endian = _get_unpack_endian_character(be)
+        self._pack_u16 = struct.Struct(endian + 'H').pack_into
+        self._pack_u32 = struct.Struct(endian + 'I').pack_into
+        self._pack_s32 = struct.Struct(endian + 'i').pack_into
+        self._pack_f32 = struct.Struct(endian + 'f').pack_into
+        self._pack_u64 = struct.Struct(endian + 'Q').pack_into
+        self._pack_s64 = struct.Struct(endian + 'q').pack_into
+        self._pack_f64 = struct.Struct(endian + 'd').pack_into
+
+        if hash_keys is None or strings is None:
+            hash_keys = set()
+            strings = set()
+            self._make_string_table(self._data, hash_keys, strings)
         # Nintendo seems to sort entries in alphabetical order.
-        self._sort_string_table(self._hash_key_table)
-        self._sort_string_table(self._string_table)
+        self._hash_key_table: typing.Dict[str, int] = {key: i for (i, key) in enumerate(sorted(hash_keys))}
+        self._string_table: typing.Dict[str, int] = {string: i for (i, string) in enumerate(sorted(strings))}
+        # Time spent collecting and sorting strings, for the stats.
+        self._string_table_time = time.perf_counter() - start
 
-    def get_bytes(self):
-        stream = io.BytesIO()
-        self.write(stream)
-        return stream.getvalue()
+    def get_bytes(self) -> bytes:
+        return bytes(self._build())
+
+    def get_buffer(self) -> bytearray:
+        """Same as get_bytes(), but the document is returned in the buffer that it was built in instead
+        of being copied to a bytes object (e.g. for passing it to yaz0.compress)."""
+        return self._build()
 
     def write(self, stream: typing.BinaryIO) -> None:
-        # Header
-        stream.write(b'BY' if self._be else b'YB')
-        stream.write(self._u16(self._version))
-        if self._hash_key_table:
-            hash_key_table_offset_writer = self._write_placeholder_offset(stream)
-        else:
-            stream.write(self._u32(0))
-        if self._string_table:
-            string_table_offset_writer = self._write_placeholder_offset(stream)
-        else:
-            stream.write(self._u32(0))
-        root_node_offset_writer = self._write_placeholder_offset(stream)
+        stream.write(self._build())
+
+    def _build(self) -> bytearray:
+        # The document is built in two passes: all offsets are computed first so that every node
+        # can then be written in place into a preallocated buffer.
+        start = time.perf_counter()
+        offset = 16
 
         # Hash key table
+        hash_key_table_offset = 0
         if self._hash_key_table:
-            hash_key_table_offset_writer.write_current_offset()
-            self._write_string_table(stream, self._hash_key_table)
-            stream.seek(_align_up(stream.tell(), 4))
+            hash_key_table_offset = offset
+            hash_keys = [bytes(key, 'utf8') for key in self._hash_key_table.keys()]
+            offset = _align_up(offset + self._get_string_table_size(hash_keys), 4)
 
         # String table
+        string_table_offset = 0
         if self._string_table:
-            string_table_offset_writer.write_current_offset()
-            self._write_string_table(stream, self._string_table)
-            stream.seek(_align_up(stream.tell(), 4))
+            string_table_offset = offset
+            strings = [bytes(string, 'utf8') for string in self._string_table.keys()]
+            offset = _align_up(offset + self._get_string_table_size(strings), 4)
 
         # Root node
-        root_node_offset_writer.write_current_offset()
+        tables_laid_out = time.perf_counter()
+        root_node_offset = offset
         # Nintendo attempts to minimize document size by reusing nodes where possible.
         # Let us do so too.
         node_to_offset_map: _NodeToOffsetMap = dict()
-        self._write_nonvalue_node(stream, self._data, node_to_offset_map)
-        stream.seek(_align_up(stream.tell(), 4))
-
-    def _make_string_table(self, data, hash_key_table: SortedDict, string_table: SortedDict):
-        if isinstance(data, str) and data not in string_table:
-            string_table[data] = 0xffffffff
-        elif isinstance(data, list):
-            for item in data:
-                self._make_string_table(item, hash_key_table, string_table)
-        elif isinstance(data, dict):
-            for (key, value) in data.items():
-                if key not in hash_key_table:
-                    hash_key_table[key] = 0xffffffff
-                self._make_string_table(value, hash_key_table, string_table)
-
-    def _sort_string_table(self, table: SortedDict):
-        for (i, key) in enumerate(table.keys()):
-            table[key] = i
-
-    def _write_string_table(self, stream: typing.BinaryIO, table: typing.Dict[str, int]):
-        base = stream.tell()
-        stream.write(self._u8(NodeType.STRING_TABLE))
-        stream.write(self._u24(len(table)))
-        offset_writers: typing.List[_PlaceholderOffsetWriter] = []
-        for i in range(len(table)):
-            offset_writers.append(self._write_placeholder_offset(stream))
-        last_offset_writer = self._write_placeholder_offset(stream)
-
-        for (string, offset_writer) in zip(table.keys(), offset_writers):
-            offset_writer.write_current_offset(base)
-            stream.write(bytes(string, "utf8"))
-            stream.write(_NUL_CHAR)
-        last_offset_writer.write_current_offset(base)
-
-    def _write_nonvalue_node(self, stream: typing.BinaryIO, data, node_to_offset_map) -> None:
-        nonvalue_nodes: typing.List[typing.Tuple[typing.Any, _PlaceholderOffsetWriter]] = []
-
-        if isinstance(data, list):
-            stream.write(self._u8(NodeType.ARRAY))
-            stream.write(self._u24(len(data)))
-            for item in data:
-                stream.write(self._u8(self._to_byml_type(item)))
-            stream.seek(_align_up(stream.tell(), 4))
-            for item in data:
-                if _is_value_type(self._to_byml_type(item)):
-                    stream.write(self._to_byml_value(item))
+        subtree_keys = _SubtreeKeys()
+        layout: typing.List[_NodeLayout] = []
+        size = self._lay_out_nonvalue_node(self._data, root_node_offset, node_to_offset_map, subtree_keys, layout)
+        # The padding after the header of an empty array is only written if another node follows.
+        last_node = layout[-1][0]
+        if isinstance(last_node, (list, tuple, TypedArray)) and not last_node:
+            size = layout[-1][1] + 4
+        nodes_laid_out = time.perf_counter()
+
+        buffer = bytearray(size)
+        buffer[0:2] = b'BY' if self._be else b'YB'
+        self._pack_u16(buffer, 2, self._version)
+        self._pack_u32(buffer, 4, hash_key_table_offset)
+        self._pack_u32(buffer, 8, string_table_offset)
+        self._pack_u32(buffer, 12, root_node_offset)
+        if hash_key_table_offset:
+            self._write_string_table(buffer, hash_key_table_offset, hash_keys)
+        if string_table_offset:
+            self._write_string_table(buffer, string_table_offset, strings)
+        tables_written = time.perf_counter()
+        for (data, node_offset, keys, node_types, child_offsets) in layout:
+            self._write_nonvalue_node(buffer, node_offset, data, keys, node_types, child_offsets)
+
+        if self.stats is not None:
+            end = time.perf_counter()
+            self.stats.document_size = len(buffer)
+            self.stats.hash_key_count = len(self._hash_key_table)
+            self.stats.hash_key_table_size = self._get_string_table_size(hash_keys) if hash_key_table_offset else 0
+            self.stats.string_count = len(self._string_table)
+            self.stats.string_table_size = self._get_string_table_size(strings) if string_table_offset else 0
+            self.stats.count_nodes(self._data)
+            # Every node that was laid out (except for the root) was referenced for the first time;
+            # all other references reuse a node.
+            self.stats.written_nodes = len(layout)
+            self.stats.reused_nodes = sum(len(child_offsets) for (_, _, _, _, child_offsets) in layout) - (len(layout) - 1)
+            self.stats.timings = {
+                'string_tables': self._string_table_time + (tables_laid_out - start) + (tables_written - nodes_laid_out),
+                'layout': nodes_laid_out - tables_laid_out,
+                'nodes': end - tables_written,
+            }
+        return buffer
+
+    def _make_string_table(self, data, hash_keys: typing.Set[str], strings: typing.Set[str]) -> None:
+        # This recurses like the layout code, so a container that contains itself raises RecursionError.
+        data_type = type(data)
+        if data_type is dict or (data_type is not list and isinstance(data, collections.abc.Mapping)):
+            hash_keys.update(data)
+            values: typing.Iterable = data.values()
+        elif data_type is not list and isinstance(data, TypedArray):
+            return
+        else:
+            values = data
+        for value in values:
+            # Dispatch on the exact type first; subclasses and other mappings go through _get_node_type.
+            value_type = type(value)
+            if value_type is str:
+                strings.add(value)
+            elif value_type in _WALKED_CONTAINER_CLASSES:
+                self._make_string_table(value, hash_keys, strings)
+            elif value_type not in _NODE_TYPES_BY_CLASS:
+                node_type = _get_node_type(value)
+                if node_type == NodeType.STRING:
+                    strings.add(value)
+                elif (node_type == NodeType.ARRAY or node_type == NodeType.HASH) and not isinstance(value, TypedArray):
+                    self._make_string_table(value, hash_keys, strings)
+
+    def _get_string_table_size(self, strings: typing.List[bytes]) -> int:
+        return 4 + 4*(len(strings) + 1) + sum(len(string) + 1 for string in strings)
+
+    def _write_string_table(self, buffer: bytearray, base: int, strings: typing.List[bytes]) -> None:
+        self._pack_node_header(buffer, base, NodeType.STRING_TABLE, len(strings))
+        offset = 4 + 4*(len(strings) + 1)
+        for (i, string) in enumerate(strings):
+            self._pack_u32(buffer, base + 4 + 4*i, offset)
+            buffer[base + offset:base + offset + len(string)] = string
+            offset += len(string) + 1
+        self._pack_u32(buffer, base + 4 + 4*len(strings), offset)
+
+    def _lay_out_nonvalue_node(self, data, offset: int, node_to_offset_map: _NodeToOffsetMap,
+                               subtree_keys: '_SubtreeKeys', layout: typing.List[_NodeLayout]) -> int:
+        """Assign offsets to a non-value node and to the nodes it references (which are placed
+        right after it). Returns the offset of the end of the last node."""
+        keys: typing.List[str] = []
+        children: typing.Sequence[typing.Any] = []
+        if isinstance(data, _ARRAY_CLASSES):
+            end = _align_up(offset + 4 + len(data), 4) + 4*len(data)
+            children = data
+        elif isinstance(data, TypedArray):
+            # Items are values, so there are no child nodes to lay out.
+            end = _align_up(offset + 4 + len(data), 4) + 4*len(data)
+        elif isinstance(data, _HASH_CLASSES):
+            end = offset + 4 + 8*len(data)
+            keys = sorted(data.keys())
+            children = [data[key] for key in keys]
+        elif isinstance(data, (bytes, memoryview)):
+            end = offset + 4 + len(data)
+        elif isinstance(data, (UInt64, Int64, Double)):
+            end = offset + 8
+        elif isinstance(data, int) or isinstance(data, float):
+            raise ValueError("Implicit conversions from int/float are not supported -- "
+                             "please use Int/Float/UInt/Int64/UInt64/Double")
+        else:
+            raise ValueError("Invalid non-value type")
+
+        node_types = [_get_node_type(child) for child in children]
+        child_offsets: typing.List[int] = []
+        layout.append((data, offset, keys, node_types, child_offsets))
+        for (child, node_type) in zip(children, node_types):
+            if _is_value_type(node_type):
+                continue
+            node = (node_type, subtree_keys.get(child))
+            if node in node_to_offset_map:
+                child_offsets.append(node_to_offset_map[node])
+            else:
+                child_offsets.append(end)
+                node_to_offset_map[node] = end
+                end = self._lay_out_nonvalue_node(child, end, node_to_offset_map, subtree_keys, layout)
+        return end
+
+    def _write_nonvalue_node(self, buffer: bytearray, offset: int, data, keys: typing.List[str],
+                             node_types: typing.List[NodeType], child_offsets: typing.List[int]) -> None:
+        next_child_offset = iter(child_offsets).__next__
+
+        if isinstance(data, _ARRAY_CLASSES):
+            self._pack_node_header(buffer, offset, NodeType.ARRAY, len(data))
+            buffer[offset + 4:offset + 4 + len(data)] = bytes(node_types)
+            value_offset = _align_up(offset + 4 + len(data), 4)
+            for (item, node_type) in zip(data, node_types):
+                if _is_value_type(node_type):
+                    self._pack_value(buffer, value_offset, node_type, item)
                 else:
-                    nonvalue_nodes.append((item, self._write_placeholder_offset(stream)))
-        elif isinstance(data, dict):
-            stream.write(self._u8(NodeType.HASH))
-            stream.write(self._u24(len(data)))
-            for key in sorted(data.keys()):
+                    self._pack_u32(buffer, value_offset, next_child_offset())
+                value_offset += 4
+        elif isinstance(data, TypedArray):
+            self._pack_node_header(buffer, offset, NodeType.ARRAY, len(data))
+            buffer[offset + 4:offset + 4 + len(data)] = bytes((data.node_type,)) * len(data)
+            if self._be != _NATIVE_BIG_ENDIAN:
+                data = array.array(data.typecode, data)
+                data.byteswap()
+            value_offset = _align_up(offset + 4 + len(data), 4)
+            buffer[value_offset:value_offset + 4*len(data)] = data.tobytes()
+        elif isinstance(data, _HASH_CLASSES):
+            self._pack_node_header(buffer, offset, NodeType.HASH, len(data))
+            entry_offset = offset + 4
+            for (key, node_type) in zip(keys, node_types):
                 value = data[key]
-                stream.write(self._u24(self._hash_key_table[key]))
-                node_type = self._to_byml_type(value)
-                stream.write(self._u8(node_type))
+                self._pack_hash_entry_header(buffer, entry_offset, self._hash_key_table[key], node_type)
                 if _is_value_type(node_type):
-                    stream.write(self._to_byml_value(value))
+                    self._pack_value(buffer, entry_offset + 4, node_type, value)
                 else:
-                    nonvalue_nodes.append((value, self._write_placeholder_offset(stream)))
-        elif isinstance(data, bytes):
-            stream.write(self._u32(len(data)))
-            stream.write(data)
+                    self._pack_u32(buffer, entry_offset + 4, next_child_offset())
+                entry_offset += 8
+        elif isinstance(data, (bytes, memoryview)):
+            self._pack_u32(buffer, offset, len(data))
+            buffer[offset + 4:offset + 4 + len(data)] = data
         elif isinstance(data, UInt64):
-            stream.write(self._u64(data))
+            self._pack_u64(buffer, offset, data)
         elif isinstance(data, Int64):
-            stream.write(self._s64(data))
+            self._pack_s64(buffer, offset, data)
         elif isinstance(data, Double):
-            stream.write(self._f64(data))
-        elif isinstance(data, int) or isinstance(data, float):
-            raise ValueError("Implicit conversions from int/float are not supported -- "
-                             "please use Int/Float/UInt/Int64/UInt64/Double")
+            self._pack_f64(buffer, offset, data)
+
+    def _pack_value(self, buffer: bytearray, offset: int, node_type: NodeType, value) -> None:
+        if node_type == NodeType.STRING:
+            self._pack_u32(buffer, offset, self._string_table[value])
+        elif node_type == NodeType.BOOL:
+            self._pack_u32(buffer, offset, 1 if value != 0 else 0)
+        elif node_type == NodeType.INT:
+            self._pack_s32(buffer, offset, value)
+        elif node_type == NodeType.UINT:
+            self._pack_u32(buffer, offset, value)
+        elif node_type == NodeType.FLOAT:
+            self._pack_f32(buffer, offset, value)
+        elif node_type == NodeType.NULL:
+            self._pack_u32(buffer, offset, 0)
         else:
-            raise ValueError("Invalid non-value type")
+            raise ValueError("Invalid value type")
 
-        for (data, offset_writer) in nonvalue_nodes:
-            node = (self._to_byml_type(data), _freeze_object(data))
-            if node in node_to_offset_map:
-                offset_writer.write_offset(node_to_offset_map[node])
-            else:
-                offset_writer.write_current_offset()
-                node_to_offset_map[node] = stream.tell()
-                self._write_nonvalue_node(stream, data, node_to_offset_map)
-
-    def _to_byml_type(self, data) -> NodeType:
-        if isinstance(data, str):
-            return NodeType.STRING
-        if isinstance(data, bytes):
-            return NodeType.BINARY
-        if isinstance(data, list):
-            return NodeType.ARRAY
-        if isinstance(data, dict):
-            return NodeType.HASH
-        if isinstance(data, bool):
-            return NodeType.BOOL
-        if isinstance(data, Int):
-            return NodeType.INT
-        if isinstance(data, Float):
-            return NodeType.FLOAT
-        if isinstance(data, UInt):
-            return NodeType.UINT
-        if isinstance(data, Int64):
-            return NodeType.INT64
-        if isinstance(data, UInt64):
-            return NodeType.UINT64
-        if isinstance(data, Double):
-            return NodeType.DOUBLE
-        if data is None:
-            return NodeType.NULL
-        if isinstance(data, int) or isinstance(data, float):
-            raise ValueError("Implicit conversions from int/float are not supported -- "
-                             "please use Int/Float/UInt/Int64/UInt64/Double")
-        raise ValueError("Invalid value type")
-
-    def _to_byml_value(self, value) -> bytes:
-        if isinstance(value, str):
-            return self._u32(self._string_table[value])
-        if isinstance(value, bool):
-            return self._u32(1 if value != 0 else 0)
-        if isinstance(value, Int):
-            return self._s32(value)
-        if isinstance(value, UInt):
-            return self._u32(value)
-        if isinstance(value, Float):
-            return self._f32(value)
-        if value is None:
-            return self._u32(0)
-        raise ValueError("Invalid value type")
-
-    def _write_placeholder_offset(self, stream) -> _PlaceholderOffsetWriter:
-        p = _PlaceholderOffsetWriter(stream, self)
-        p.write_placeholder()
-        return p
-
-    def _u8(self, value) -> bytes:
-        return struct.pack('B', value)
-    def _u16(self, value) -> bytes:
-        return struct.pack(_get_unpack_endian_character(self._be) + 'H', value)
-    def _s16(self, value) -> bytes:
-        return struct.pack(_get_unpack_endian_character(self._be) + 'h', value)
-    def _u24(self, value) -> bytes:
-        b = struct.pack(_get_unpack_endian_character(self._be) + 'I', value)
-        return b[1:] if self._be else b[:-1]
-    def _u32(self, value) -> bytes:
-        return struct.pack(_get_unpack_endian_character(self._be) + 'I', value)
-    def _s32(self, value) -> bytes:
-        return struct.pack(_get_unpack_endian_character(self._be) + 'i', value)
-    def _u64(self, value) -> bytes:
-        return struct.pack(_get_unpack_endian_character(self._be) + 'Q', value)
-    def _s64(self, value) -> bytes:
-        return struct.pack(_get_unpack_endian_character(self._be) + 'q', value)
-    def _f32(self, value) -> bytes:
-        return struct.pack(_get_unpack_endian_character(self._be) + 'f', value)
-    def _f64(self, value) -> bytes:
-        return struct.pack(_get_unpack_endian_character(self._be) + 'd', value)
+    def _pack_node_header(self, buffer: bytearray, offset: int, node_type: NodeType, size: int) -> None:
+        # u8 node type followed by a u24 size
+        self._pack_u32(buffer, offset, (node_type << 24 | size) if self._be else (size << 8 | node_type))
+
+    def _pack_hash_entry_header(self, buffer: bytearray, offset: int, key_index: int, node_type: NodeType) -> None:
+        # u24 key index followed by a u8 node type
+        self._pack_u32(buffer, offset, (key_index << 8 | node_type) if self._be else (node_type << 24 | key_index))
@@ -0,0 +1,169 @@
+import argparse
+import collections
+import concurrent.futures
+import fnmatch
+import glob
+import os
+import sys
+import time
+import typing
+
+from . import byml_to_yml
+from . import cache as byml_cache
+from . import yaz0
+from . import yml_to_byml
+
+_DEFAULT_PATTERNS = {
+    'to_yml': '*byml',
+    'to_byml': '*.yml',
+}
+_DEFAULT_OUTPUTS = {
+    'to_yml': '!!.yml',
+    'to_byml': '!!.byml',
+}
+
+class _Job(typing.NamedTuple):
+    mode: str
+    src: str
+    dst: str
+    to_json: bool
+    be: bool
+    version: int
+    cache_dir: typing.Optional[str]
+    cache_size: int
+    compression_level: int
+    # Whether outputs that need to be compressed should be returned to the main process
+    # uncompressed (see _compress) instead of being compressed and written by the worker.
+    defer_compression: bool
+
+class _Result(typing.NamedTuple):
+    src: str
+    dst: str
+    size: int
+    seconds: float
+    error: typing.Optional[str]
+    # Uncompressed output that still needs to be compressed and written.
+    data: typing.Optional[bytes] = None
+
+def _find_inputs(inputs: typing.List[str], pattern: str) -> typing.List[str]:
+    paths: typing.List[str] = []
+    for arg in inputs:
+        if os.path.isdir(arg):
+            for (dirpath, _, filenames) in os.walk(arg):
+                paths.extend(os.path.join(dirpath, name) for name in sorted(filenames) if fnmatch.fnmatch(name, pattern))
+        elif glob.has_magic(arg):
+            paths.extend(sorted(glob.glob(arg, recursive=True)))
+        else:
+            paths.append(arg)
+    return paths
+
+# Caches used by this (worker) process, keyed by (directory, maximum size). Keeping them for the whole
+# batch lets them track their size instead of scanning their directory after every store.
+_caches: typing.Dict[typing.Tuple[str, int], byml_cache.ConversionCache] = dict()
+
+def _get_cache(directory: str, max_size: int) -> byml_cache.ConversionCache:
+    cache = _caches.get((directory, max_size))
+    if cache is None:
+        cache = _caches[(directory, max_size)] = byml_cache.ConversionCache(directory, max_size)
+    return cache
+
+def _convert(job: _Job) -> _Result:
+    start = time.perf_counter()
+    size = 0
+    error = None
+    data = None
+    try:
+        size = os.path.getsize(job.src)
+        cache = _get_cache(job.cache_dir, job.cache_size) if job.cache_dir else None
+        if job.mode == 'to_yml':
+            byml_to_yml.convert(job.src, job.dst, to_json=job.to_json, cache=cache)
+        elif job.defer_compression and yml_to_byml.should_compress(job.dst):
+            with open(job.src, 'rb') as file:
+                data = yml_to_byml.convert_data(file.read(), job.be, job.version)
+        else:
+            yml_to_byml.convert(job.src, job.dst, be=job.be, version=job.version, cache=cache,
+                                compression_level=job.compression_level)
+    except Exception as e:
+        error = '%s: %s' % (type(e).__name__, e)
+    return _Result(job.src, job.dst, size, time.perf_counter() - start, error, data)
+
+def _compress(result: _Result, level: int) -> _Result:
+    """Compress and write an output that was converted by a worker process. This runs on a thread
+    pool in the main process: oead releases the GIL while compressing."""
+    start = time.perf_counter()
+    error = None
+    try:
+        data = yaz0.compress(result.data, level)
+        with open(result.dst, 'wb') as output:
+            output.write(data)
+    except Exception as e:
+        error = '%s: %s' % (type(e).__name__, e)
+    return result._replace(seconds=result.seconds + time.perf_counter() - start, error=error, data=None)
+
+def _format_throughput(size: int, seconds: float) -> str:
+    return '%.2f MB/s' % (size / 1e6 / seconds) if seconds > 0 else 'n/a'
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Converts many BYML or YAML files in parallel.')
+    parser.add_argument('mode', choices=['to_yml', 'to_byml'], help='Conversion direction')
+    parser.add_argument('inputs', nargs='+', help='Input files, directories or glob patterns')
+    parser.add_argument('-o', '--output', help='Destination path for each file; !! is replaced with the input path without extension (default: !!.yml or !!.byml)')
+    parser.add_argument('-p', '--pattern', help='File name pattern used when searching directories (default: *byml or *.yml)')
+    parser.add_argument('-n', '--jobs', type=int, default=None, help='Number of worker processes (default: number of CPUs)')
+    parser.add_argument('-j', '--to-json', action='store_true', help='[to_yml] Convert to JSON (warning: one-way conversion; does not preserve type information)')
+    parser.add_argument('-V', '--version', type=int, default=2, help='[to_byml] BYML version (1, 2, 3)')
+    parser.add_argument('-b', '--be', action='store_true', help='[to_byml] Use big endian. Defaults to false.')
+    parser.add_argument('-l', '--compression-level', type=int, choices=yaz0.COMPRESSION_LEVELS,
+                        default=yaz0.DEFAULT_COMPRESSION_LEVEL,
+                        help='[to_byml] Yaz0 compression level for .s* outputs (6 is the fastest, 9 gives the smallest files)')
+    parser.add_argument('-t', '--compress-threads', type=int, metavar='N',
+                        help='[to_byml] Compress .s* outputs on N threads in the main process, in parallel with the '
+                             'conversions, instead of in the worker processes (not used with --cache)')
+    parser.add_argument('--cache', metavar='DIR', help='Store conversion results in DIR and reuse them for identical inputs')
+    parser.add_argument('--cache-size', type=int, default=byml_cache.DEFAULT_MAX_SIZE // (1024*1024), metavar='MB',
+                        help='Maximum size of the cache in MiB')
+    args = parser.parse_args()
+
+    output = args.output or _DEFAULT_OUTPUTS[args.mode]
+    if '!!' not in output:
+        sys.stderr.write('error: the output path must contain !! (for input filename)\n')
+        sys.exit(1)
+    paths = _find_inputs(args.inputs, args.pattern or _DEFAULT_PATTERNS[args.mode])
+    defer_compression = args.compress_threads is not None and not args.cache
+    jobs = [_Job(args.mode, path, output.replace('!!', os.path.splitext(path)[0]), args.to_json, args.be, args.version,
+                 args.cache, args.cache_size * 1024*1024, args.compression_level, defer_compression) for path in paths]
+
+    failures = 0
+    total_size = 0
+
+    def finish(result: _Result) -> None:
+        nonlocal failures, total_size
+        if result.error is not None:
+            failures += 1
+            sys.stderr.write('error: %s: %s\n' % (result.src, result.error))
+            return
+        total_size += result.size
+        sys.stderr.write('%s -> %s (%u bytes, %.3f s, %s)\n' % (result.src, result.dst, result.size,
+                         result.seconds, _format_throughput(result.size, result.seconds)))
+
+    start = time.perf_counter()
+    compressions: typing.Deque[concurrent.futures.Future] = collections.deque()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor, \
+         concurrent.futures.ThreadPoolExecutor(max_workers=args.compress_threads or 1) as compressor:
+        for result in executor.map(_convert, jobs, chunksize=4):
+            if result.data is not None:
+                compressions.append(compressor.submit(_compress, result, args.compression_level))
+            else:
+                finish(result)
+            while compressions and compressions[0].done():
+                finish(compressions.popleft().result())
+        for future in compressions:
+            finish(future.result())
+    elapsed = time.perf_counter() - start
+    sys.stderr.write('converted %u file(s), %u failed, %u bytes in %.3f s (%s)\n' % (len(jobs) - failures, failures,
+                     total_size, elapsed, _format_throughput(total_size, elapsed)))
+    if failures:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,41 +1,129 @@
 import argparse
-import json
+import mmap
 import os
 import sys
-import yaml
+import typing
 
 from . import byml
-import oead
-from . import yaml_util
+from . import cache as byml_cache
+from . import yaml_emitter
+from . import yaz0
+
+def _map_input(file: typing.BinaryIO) -> typing.Union[bytes, mmap.mmap]:
+    """Memory-map an input file, or read it if it cannot be mapped (pipes, empty files...)."""
+    try:
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return file.read()
+
+def make_parser(data: typing.Union[bytes, mmap.mmap], **kwargs) -> byml.Byml:
+    """Create a parser for a BYML document, decompressing it first if it is Yaz0 compressed.
+    kwargs are passed to byml.Byml."""
+    if yaz0.is_compressed(data):
+        data = yaz0.decompress(data)
+    return byml.Byml(data, **kwargs)
+
+def load_byml(data: typing.Union[bytes, mmap.mmap]) -> typing.Union[list, dict, None]:
+    """Parse a BYML document, decompressing it first if it is Yaz0 compressed."""
+    return make_parser(data).parse()
+
+def _get_dumper():
+    import yaml
+    from . import yaml_util
+    dumper = yaml.CDumper
+    yaml_util.add_representers(dumper)
+    return dumper
+
+def dump_yml(root, output: typing.TextIO, to_json: bool = False) -> None:
+    if to_json:
+        import json
+        json.dump(root, output, ensure_ascii=False)
+    else:
+        try:
+            output.write(yaml_emitter.dumps(root))
+        except yaml_emitter.UnsupportedDataError:
+            import yaml
+            dumper = _get_dumper()
+            yaml.dump(root, output, Dumper=dumper, allow_unicode=True, encoding='utf-8', default_flow_style=None)
+
+def dumps_yml(root, to_json: bool = False) -> bytes:
+    if to_json:
+        import json
+        return json.dumps(root, ensure_ascii=False).encode('utf-8')
+    try:
+        return yaml_emitter.dumps(root).encode('utf-8')
+    except yaml_emitter.UnsupportedDataError:
+        import yaml
+        dumper = _get_dumper()
+        return yaml.dump(root, Dumper=dumper, allow_unicode=True, encoding='utf-8', default_flow_style=None)
+
+def convert_cached(data, cache: byml_cache.ConversionCache, to_json: bool = False) -> bytes:
+    """Convert a BYML document to YAML (or JSON), reusing the cached output if there is one."""
+    key = cache.make_key(data, tool='byml_to_yml', to_json=to_json)
+    output = cache.get(key)
+    if output is None:
+        output = dumps_yml(load_byml(data), to_json)
+        cache.put(key, output)
+    return output
+
+def convert(byml_path: str, yml_path: str, to_json: bool = False,
+            cache: typing.Optional[byml_cache.ConversionCache] = None) -> None:
+    """Convert a BYML file to YAML (or JSON)."""
+    with open(byml_path, 'rb') as file:
+        data = _map_input(file)
+        if cache is not None:
+            output = convert_cached(data, cache, to_json)
+            with open(yml_path, 'wb') as binary_output:
+                binary_output.write(output)
+            return
+        root = load_byml(data)
+    with open(yml_path, 'w', encoding='utf-8') as text_output:
+        dump_yml(root, text_output, to_json)
 
 def main() -> None:
     parser = argparse.ArgumentParser(description='Converts a BYML file to YAML.')
     parser.add_argument('-j', '--to-json', action='store_true', help='Convert to JSON (warning: one-way conversion; does not preserve type information)')
     parser.add_argument('byml', help='Path to a BYML file', nargs='?', default='-')
     parser.add_argument('yml', help='Path to destination YAML file', nargs='?', default='-')
+    parser.add_argument('--serve', metavar='SOCKET', help='Run a conversion server on the Unix socket SOCKET (see byml_client) instead of converting a file')
+    parser.add_argument('--cache', metavar='DIR', help='Store conversion results in DIR and reuse them for identical inputs')
+    parser.add_argument('--cache-size', type=int, default=byml_cache.DEFAULT_MAX_SIZE // (1024*1024), metavar='MB',
+                        help='Maximum size of the cache in MiB')
+    parser.add_argument('--stats', action='store_true', help='Print statistics about the document to stderr (not with --cache)')
     args = parser.parse_args()
 
-    dumper = yaml.CDumper
-    yaml_util.add_representers(dumper)
+    if args.serve:
+        from . import server
+        server.serve(args.serve)
+        return
 
     file = sys.stdin.buffer if args.byml == '-' else open(args.byml, 'rb')
     with file:
-        data = file.read()
-        if data[0:4] == b'Yaz0':
-            data = oead.yaz0.decompress(data)
-        root = byml.Byml(data).parse()
+        if args.byml == '-':
+            data = file.read()
+        else:
+            data = _map_input(file)
 
         if args.byml != '-':
             args.yml = args.yml.replace('!!', os.path.splitext(args.byml)[0])
         elif '!!' in args.yml:
             sys.stderr.write('error: cannot use !! (for input filename) when reading from stdin\n')
             sys.exit(1)
+        if args.cache:
+            cache = byml_cache.ConversionCache(args.cache, args.cache_size * 1024*1024)
+            converted = convert_cached(data, cache, args.to_json)
+            binary_output = sys.stdout.buffer if args.yml == '-' else open(args.yml, 'wb')
+            with binary_output:
+                binary_output.write(converted)
+            return
+
+        byml_parser = make_parser(data, stats=args.stats)
+        root = byml_parser.parse()
+        if byml_parser.stats is not None:
+            sys.stderr.write('%s\n' % byml_parser.stats)
         output = sys.stdout if args.yml == '-' else open(args.yml, 'w', encoding='utf-8')
         with output:
-            if args.to_json:
-                json.dump(root, output, ensure_ascii=False)
-            else:
-                yaml.dump(root, output, Dumper=dumper, allow_unicode=True, encoding='utf-8', default_flow_style=None)
+            dump_yml(root, output, args.to_json)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,82 @@
+import os
+import typing
+
+DEFAULT_MAX_SIZE = 512 * 1024 * 1024
+
+class ConversionCache:
+    """On-disk cache of conversion results, keyed by the contents of the input and the conversion options.
+
+    Entries are evicted in least recently used order (based on their modification time, which is
+    updated on every hit) once the total size of the cache exceeds max_size bytes. The directory is
+    only scanned when a running estimate of its size exceeds max_size, and eviction then goes down
+    to 90% of max_size so that scans do not happen again on every store.
+    """
+
+    def __init__(self, directory: str, max_size: int = DEFAULT_MAX_SIZE) -> None:
+        self._directory = directory
+        self._max_size = max_size
+        # Total size of the entries as of the last scan plus the size of the entries stored since then
+        # (None until the first store). Entries stored by other processes are counted on the next scan.
+        self._size_estimate: typing.Optional[int] = None
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def make_key(data, **options) -> str:
+        # Imported here so that the command line tools do not load them when the cache is not used.
+        import hashlib
+        import json
+        from . import __version__
+        h = hashlib.sha256()
+        h.update(json.dumps(dict(options, library_version=__version__), sort_keys=True).encode())
+        h.update(b'\x00')
+        h.update(data)
+        return h.hexdigest()
+
+    def get(self, key: str) -> typing.Optional[bytes]:
+        path = os.path.join(self._directory, key)
+        try:
+            with open(path, 'rb') as file:
+                value = file.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return value
+
+    def put(self, key: str, value: bytes) -> None:
+        import tempfile
+        # Write to a temporary file first so that concurrent readers never see partial entries.
+        fd, tmp_path = tempfile.mkstemp(dir=self._directory, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(value)
+            os.replace(tmp_path, os.path.join(self._directory, key))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        if self._size_estimate is not None:
+            self._size_estimate += len(value)
+        if self._size_estimate is None or self._size_estimate > self._max_size:
+            self._evict()
+
+    def _evict(self) -> None:
+        entries = []
+        total_size = 0
+        with os.scandir(self._directory) as it:
+            for entry in it:
+                if entry.name.startswith('.') or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total_size += stat.st_size
+        if total_size > self._max_size:
+            target_size = self._max_size * 9 // 10
+            entries.sort()
+            for (_, size, path) in entries:
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                total_size -= size
+                if total_size <= target_size:
+                    break
+        self._size_estimate = total_size
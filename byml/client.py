@@ -0,0 +1,107 @@
+"""Client for the conversion server (byml_to_yml --serve).
+
+This module only depends on the standard library (and byml.yaz0, which does too) so that the client starts quickly.
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+import typing
+
+from . import yaz0
+
+def write_message(stream: typing.BinaryIO, header: dict, payload: bytes) -> None:
+    """Send a JSON header line (with the payload size) followed by the payload."""
+    # A single write, so that the peer never sees a header without its payload.
+    stream.write(b'%s\n%s' % (json.dumps(dict(header, size=len(payload))).encode('utf-8'), payload))
+    stream.flush()
+
+def read_message(stream: typing.BinaryIO) -> typing.Optional[typing.Tuple[dict, bytes]]:
+    """Receive a message sent with write_message. Returns None if the connection was closed."""
+    line = stream.readline()
+    if not line:
+        return None
+    header = json.loads(line)
+    payload = stream.read(header['size'])
+    if len(payload) != header['size']:
+        raise EOFError('Connection closed in the middle of a message')
+    return (header, payload)
+
+class Client:
+    """Sends conversion requests to a conversion server over a Unix socket."""
+
+    def __init__(self, socket_path: str) -> None:
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(socket_path)
+        self._stream = self._socket.makefile('rwb')
+
+    def convert(self, tool: str, data: bytes, **options) -> bytes:
+        """Convert data with the given tool ('byml_to_yml' or 'yml_to_byml') and options."""
+        write_message(self._stream, dict(options, tool=tool), data)
+        response = read_message(self._stream)
+        if response is None:
+            raise EOFError('Connection closed by the server')
+        (header, payload) = response
+        if 'error' in header:
+            raise RuntimeError(header['error'])
+        return payload
+
+    def close(self) -> None:
+        self._stream.close()
+        self._socket.close()
+
+    def __enter__(self) -> 'Client':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Converts a file using a conversion server (byml_to_yml --serve).')
+    parser.add_argument('socket', help='Path to the server socket')
+    subparsers = parser.add_subparsers(dest='tool')
+    subparsers.required = True
+    to_yml = subparsers.add_parser('byml_to_yml', help='Convert a BYML file to YAML')
+    to_yml.add_argument('-j', '--to-json', action='store_true', help='Convert to JSON (warning: one-way conversion; does not preserve type information)')
+    to_yml.add_argument('src', help='Path to a BYML file', nargs='?', default='-')
+    to_yml.add_argument('dst', help='Path to destination YAML file', nargs='?', default='-')
+    to_byml = subparsers.add_parser('yml_to_byml', help='Convert a YAML file to BYML')
+    to_byml.add_argument('src', help='Path to a YAML file', nargs='?', default='-')
+    to_byml.add_argument('dst', help='Path to destination BYAML file', nargs='?', default='-')
+    to_byml.add_argument('-V', '--version', type=int, default=2, help='BYML version (1, 2, 3)')
+    to_byml.add_argument('-b', '--be', action='store_true', help='Use big endian. Defaults to false.')
+    to_byml.add_argument('-l', '--compression-level', type=int, choices=yaz0.COMPRESSION_LEVELS,
+                         default=yaz0.DEFAULT_COMPRESSION_LEVEL,
+                         help='Yaz0 compression level for .s* outputs (6 is the fastest, 9 gives the smallest files)')
+    args = parser.parse_args()
+
+    if args.src != '-':
+        args.dst = args.dst.replace('!!', os.path.splitext(args.src)[0])
+    elif '!!' in args.dst:
+        sys.stderr.write('error: cannot use !! (for input filename) when reading from stdin\n')
+        sys.exit(1)
+
+    file = sys.stdin.buffer if args.src == '-' else open(args.src, 'rb')
+    with file:
+        data = file.read()
+
+    if args.tool == 'byml_to_yml':
+        options: dict = dict(to_json=args.to_json)
+    else:
+        compress = args.dst != '-' and os.path.splitext(args.dst)[1].startswith('.s')
+        options = dict(be=args.be, version=args.version, compress=compress, compression_level=args.compression_level)
+
+    with Client(args.socket) as client:
+        try:
+            output_data = client.convert(args.tool, data, **options)
+        except RuntimeError as e:
+            sys.stderr.write('error: %s\n' % e)
+            sys.exit(1)
+
+    output = sys.stdout.buffer if args.dst == '-' else open(args.dst, 'wb')
+    with output:
+        output.write(output_data)
+
+if __name__ == '__main__':
+    main()
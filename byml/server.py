@@ -0,0 +1,58 @@
+"""Conversion server: keeps the converters loaded and handles requests sent by byml.client over a Unix socket."""
+import os
+import socketserver
+import stat
+import sys
+
+from . import byml_to_yml
+from . import yaz0
+from . import yml_to_byml
+from .client import read_message, write_message
+
+def _convert(header: dict, payload: bytes) -> bytes:
+    tool = header.get('tool')
+    if tool == 'byml_to_yml':
+        return byml_to_yml.dumps_yml(byml_to_yml.load_byml(payload), bool(header.get('to_json', False)))
+    if tool == 'yml_to_byml':
+        compression_level = int(header.get('compression_level', yaz0.DEFAULT_COMPRESSION_LEVEL))
+        return yml_to_byml.convert_data(payload, be=bool(header.get('be', False)), version=int(header.get('version', 2)),
+                                        compress=bool(header.get('compress', False)), compression_level=compression_level)
+    raise ValueError('Unknown tool: %r' % tool)
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        # A connection can be used for any number of requests.
+        try:
+            while True:
+                message = read_message(self.rfile)
+                if message is None:
+                    return
+                (header, payload) = message
+                try:
+                    output = _convert(header, payload)
+                except Exception as e:
+                    write_message(self.wfile, {'error': '%s: %s' % (type(e).__name__, e)}, b'')
+                    continue
+                write_message(self.wfile, {}, output)
+        except BrokenPipeError:
+            # The client went away without waiting for the response.
+            pass
+
+def serve(socket_path: str) -> None:
+    """Handle conversion requests on a Unix socket until interrupted."""
+    # Remove a socket left behind by a server that was not shut down cleanly.
+    if os.path.exists(socket_path) and stat.S_ISSOCK(os.stat(socket_path).st_mode):
+        os.unlink(socket_path)
+    # Load the YAML dumper and loader now rather than on the first request.
+    byml_to_yml._get_dumper()
+    yml_to_byml._get_loader()
+    server = socketserver.ThreadingUnixStreamServer(socket_path, _RequestHandler)
+    server.daemon_threads = True
+    sys.stderr.write('listening on %s\n' % socket_path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
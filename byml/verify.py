@@ -0,0 +1,333 @@
+"""In-process round-trip verification. Run with python -m byml.verify [PATH...]"""
+import argparse
+import collections.abc
+import concurrent.futures
+import contextlib
+import io
+import math
+import os
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+
+from . import bench
+
+class Result(typing.NamedTuple):
+    path: str
+    # Failed checks; the file passed verification if this is empty.
+    errors: typing.List[str]
+    # Checks that were skipped and other remarks.
+    notes: typing.List[str]
+    seconds: float
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors
+
+def find_difference(a, b) -> typing.Optional[str]:
+    """Compare two parsed documents, including value types (Int(1) and UInt(1) are different).
+
+    Returns None if they are identical, or the path of the first node that differs otherwise
+    (in the same format as Byml.get paths; the root node is an empty path)."""
+    stack = [((), a, b)]
+    while stack:
+        (path, a, b) = stack.pop()
+        if type(a) is not type(b):
+            return '/'.join(path)
+        if isinstance(a, dict):
+            if a.keys() != b.keys():
+                return '/'.join(path)
+            stack.extend((path + (key,), a[key], b[key]) for key in reversed(list(a.keys())))
+        elif isinstance(a, list):
+            if len(a) != len(b):
+                return '/'.join(path)
+            stack.extend((path + (str(i),), a[i], b[i]) for i in reversed(range(len(a))))
+        elif isinstance(a, float):
+            if a != b and not (math.isnan(a) and math.isnan(b)):
+                return '/'.join(path)
+        elif a != b:
+            return '/'.join(path)
+    return None
+
+def _describe_path(path: str) -> str:
+    return path if path else '(root)'
+
+def _to_plain(node):
+    """Convert lazy proxies, typed arrays, tuples and read-only mappings to the lists and dicts that
+    parse() returns, so that documents parsed in other ways can be compared with find_difference."""
+    from . import byml
+    if isinstance(node, byml.TypedArray):
+        return [node.item_type(item) for item in node]
+    if isinstance(node, (list, tuple, byml.LazyArray)):
+        return [_to_plain(item) for item in node]
+    if isinstance(node, collections.abc.Mapping):
+        return {key: _to_plain(value) for (key, value) in node.items()}
+    return node
+
+def _build_from_events(events: typing.Iterable[typing.Tuple[typing.Any, typing.Any]]):
+    """Build the document that a Byml.iter_events event stream describes."""
+    from .byml import EventType
+    # (container, key of the next hash item)
+    stack: list = [([], None)]
+    for (event_type, value) in events:
+        if event_type == EventType.KEY:
+            stack[-1] = (stack[-1][0], value)
+            continue
+        if event_type == EventType.START_ARRAY or event_type == EventType.START_HASH:
+            stack.append(([] if event_type == EventType.START_ARRAY else {}, None))
+            continue
+        if event_type == EventType.END_ARRAY or event_type == EventType.END_HASH:
+            value = stack.pop()[0]
+        (container, key) = stack[-1]
+        if isinstance(container, list):
+            container.append(value)
+        else:
+            container[key] = value
+    return stack[0][0][0]
+
+def _read_document(path: str):
+    from . import yaz0
+    with open(path, 'rb') as file:
+        data = file.read()
+    if yaz0.is_compressed(data):
+        data = yaz0.decompress(data)
+    return data
+
+def _get_format(data) -> typing.Tuple[bool, int]:
+    """Get the endianness (True for big endian) and the version of a BYML document."""
+    be = data[0:2] == b'BY'
+    return (be, struct.unpack_from('>H' if be else '<H', data, 2)[0])
+
+def _check(path: str, yml_path: typing.Optional[str], errors: typing.List[str], notes: typing.List[str]) -> None:
+    from . import byml
+    from . import byml_to_yml
+    from . import yml_to_byml
+
+    data = _read_document(path)
+    root = byml.Byml(data).parse()
+    if root is None:
+        notes.append('empty document')
+        return
+    (be, version) = _get_format(data)
+
+    # BYML -> YAML, compared to the known output if there is one.
+    yml_data = byml_to_yml.dumps_yml(root)
+    if yml_path is None:
+        candidate = os.path.splitext(path)[0] + '.yml'
+        if candidate != path and os.path.exists(candidate):
+            yml_path = candidate
+    if yml_path is None:
+        notes.append('no known YAML output; skipped the YAML comparison')
+    else:
+        with open(yml_path, 'rb') as file:
+            if yml_data != file.read():
+                errors.append('parse: generated YAML does not match %s' % yml_path)
+
+    # The other ways of parsing a document, which should all agree with parse(). They are built one
+    # at a time to keep memory usage down. Typed arrays are checked by writing them below.
+    def get_items():
+        parser = byml.Byml(data)
+        if isinstance(root, dict):
+            return {key: parser.get([key]) for key in root}
+        return [parser.get([index]) for index in range(len(root))]
+    variants: typing.List[typing.Tuple[str, typing.Callable[[], typing.Any]]] = [
+        ('parse_iterative', lambda: byml.Byml(data).parse_iterative()),
+        ('parse_lazy', lambda: _to_plain(byml.Byml(data).parse_lazy())),
+        ('iter_events', lambda: _build_from_events(byml.Byml(data).iter_events())),
+        ('get', get_items),
+        ('share_nodes', lambda: _to_plain(byml.Byml(data, share_nodes=True, immutable_nodes=True, typed_arrays=True).parse())),
+    ]
+    for (name, parse) in variants:
+        difference = find_difference(root, parse())
+        if difference is not None:
+            errors.append('%s: the document differs from parse() at %s' % (name, _describe_path(difference)))
+
+    # Document -> BYML -> document, with statistics: the writer's should describe the document that
+    # it wrote, as the parser sees it.
+    writer = byml.Writer(root, be=be, version=version, stats=True)
+    written = writer.get_bytes()
+    written_parser = byml.Byml(written, stats=True)
+    written_root = written_parser.parse()
+    difference = find_difference(root, written_root)
+    if difference is not None:
+        errors.append('write: the written document differs from the original at %s' % _describe_path(difference))
+    elif byml.Writer(written_root, be=be, version=version).get_bytes() != written:
+        errors.append('write: writing the written document again gives different bytes')
+    if byml.Writer(byml.Byml(data, typed_arrays=True).parse(), be=be, version=version).get_bytes() != written:
+        errors.append('typed_arrays: writing the document gives different bytes')
+    for name in ('node_counts', 'document_size', 'hash_key_count', 'hash_key_table_size', 'string_count',
+                 'string_table_size'):
+        (write_value, parse_value) = (getattr(writer.stats, name), getattr(written_parser.stats, name))
+        if write_value != parse_value:
+            errors.append('stats: %s is %r for the writer and %r for the parser' % (name, write_value, parse_value))
+
+    # YAML -> BYML, which should give the same bytes as writing the parsed document.
+    if yml_to_byml.make_writer(yml_data, be, version).get_bytes() != written:
+        errors.append('roundtrip: converting the generated YAML to BYML gives different bytes than writing the document')
+
+def roundtrip(path: str, yml_path: typing.Optional[str] = None) -> Result:
+    """Check that a BYML file (possibly Yaz0 compressed) survives conversions without any change.
+
+    The document is converted to YAML, which is compared to the contents of yml_path (by default, the
+    file with the same name and a .yml extension, if there is one). It is then written back to BYML
+    and parsed again, and converting the YAML back to BYML must give the same bytes. The other parsing
+    methods and options must give the same document as parse(), and statistics collected by the
+    writer and the parser must agree.
+    """
+    start = time.perf_counter()
+    errors: typing.List[str] = []
+    notes: typing.List[str] = []
+    try:
+        _check(path, yml_path, errors, notes)
+    except Exception as e:
+        errors.append('%s: %s' % (type(e).__name__, e))
+    return Result(path, errors, notes, time.perf_counter() - start)
+
+def verify_files(paths: typing.List[str], jobs: typing.Optional[int] = None) -> typing.Iterator[Result]:
+    """Run roundtrip on every BYML file in a list of files and directories, in a pool of worker processes
+    (or in this process if jobs is 1). Results are generated in order."""
+    documents = bench.find_documents(paths)
+    if jobs == 1:
+        yield from map(roundtrip, documents)
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        yield from executor.map(roundtrip, documents, chunksize=4)
+
+def _run_main(main: typing.Callable[[], None], args: typing.List[str]) -> str:
+    """Run the main function of a command line tool with arguments and get what it wrote to stderr."""
+    stderr = io.StringIO()
+    argv = sys.argv
+    sys.argv = [main.__module__] + args
+    try:
+        with contextlib.redirect_stderr(stderr):
+            main()
+    except SystemExit as e:
+        if e.code:
+            raise RuntimeError('%s exited with status %s: %s' % (main.__module__, e.code, stderr.getvalue().strip()))
+    finally:
+        sys.argv = argv
+    return stderr.getvalue()
+
+def _compare_file(path: str, expected: bytes, description: str, errors: typing.List[str]) -> None:
+    with open(path, 'rb') as file:
+        if file.read() != expected:
+            errors.append('%s: the output differs from the library\'s' % description)
+
+def _check_tools(path: str, errors: typing.List[str], notes: typing.List[str]) -> None:
+    from . import byml_batch
+    from . import byml_to_yml
+    from . import client
+    from . import yml_to_byml
+
+    data = _read_document(path)
+    (be, version) = _get_format(data)
+    expected_yml = byml_to_yml.dumps_yml(byml_to_yml.load_byml(data))
+    expected_byml = yml_to_byml.make_writer(expected_yml, be, version).get_bytes()
+    format_args = ['-V', str(version)] + (['-b'] if be else [])
+
+    with tempfile.TemporaryDirectory(prefix='byml') as directory:
+        yml_path = os.path.join(directory, 'document.yml')
+        byml_path = os.path.join(directory, 'document.byml')
+
+        stderr = _run_main(byml_to_yml.main, [path, yml_path, '--stats'])
+        _compare_file(yml_path, expected_yml, 'byml_to_yml', errors)
+        if 'document:' not in stderr:
+            errors.append('byml_to_yml: --stats did not print statistics')
+        stderr = _run_main(yml_to_byml.main, [yml_path, byml_path, '--stats'] + format_args)
+        _compare_file(byml_path, expected_byml, 'yml_to_byml', errors)
+        if 'document:' not in stderr:
+            errors.append('yml_to_byml: --stats did not print statistics')
+
+        # The second run of each tool uses the cached output.
+        cache_path = os.path.join(directory, 'cache')
+        for run in ('first', 'second'):
+            _run_main(byml_to_yml.main, [path, yml_path, '--cache', cache_path])
+            _compare_file(yml_path, expected_yml, 'byml_to_yml --cache (%s run)' % run, errors)
+            _run_main(yml_to_byml.main, [yml_path, byml_path, '--cache', cache_path] + format_args)
+            _compare_file(byml_path, expected_byml, 'yml_to_byml --cache (%s run)' % run, errors)
+        if len(os.listdir(cache_path)) != 2:
+            errors.append('--cache: expected 2 cache entries, found %u' % len(os.listdir(cache_path)))
+
+        batch_path = os.path.join(directory, 'batch')
+        os.mkdir(batch_path)
+        with open(os.path.join(batch_path, 'document.byml'), 'wb') as file:
+            file.write(data)
+        _run_main(byml_batch.main, ['to_yml', batch_path, '-n', '1'])
+        _compare_file(os.path.join(batch_path, 'document.yml'), expected_yml, 'byml_batch to_yml', errors)
+        _run_main(byml_batch.main, ['to_byml', batch_path, '-n', '1', '-o', '!!.new.byml'] + format_args)
+        _compare_file(os.path.join(batch_path, 'document.new.byml'), expected_byml, 'byml_batch to_byml', errors)
+
+        if not hasattr(socket, 'AF_UNIX'):
+            notes.append('Unix sockets are not available; skipped the server and client check')
+            return
+        # The server runs until it is interrupted, so it gets its own process.
+        socket_path = os.path.join(directory, 'server.sock')
+        server = subprocess.Popen([sys.executable, '-m', 'byml.byml_to_yml', '--serve', socket_path],
+                                  cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                  stderr=subprocess.PIPE, universal_newlines=True)
+        try:
+            # The server prints a line once it is listening.
+            if not server.stderr.readline():
+                raise RuntimeError('the conversion server did not start')
+            _run_main(client.main, [socket_path, 'byml_to_yml', path, yml_path])
+            _compare_file(yml_path, expected_yml, 'byml_client byml_to_yml', errors)
+            _run_main(client.main, [socket_path, 'yml_to_byml', yml_path, byml_path] + format_args)
+            _compare_file(byml_path, expected_byml, 'byml_client yml_to_byml', errors)
+        finally:
+            server.send_signal(signal.SIGINT)
+            server_errors = server.communicate(timeout=30)[1]
+        if server.returncode != 0 or server_errors:
+            errors.append('server: exited with status %s: %s' % (server.returncode, server_errors.strip()))
+
+def check_tools(path: str) -> Result:
+    """Check that the command line tools (byml_to_yml and yml_to_byml, with --stats and --cache, byml_batch
+    and byml_client with a conversion server) give the same outputs as the library for a BYML file.
+
+    The tools run in this process, except for the server."""
+    start = time.perf_counter()
+    errors: typing.List[str] = []
+    notes: typing.List[str] = []
+    try:
+        _check_tools(path, errors, notes)
+    except Exception as e:
+        errors.append('%s: %s' % (type(e).__name__, e))
+    return Result(path, errors, notes, time.perf_counter() - start)
+
+def _print_result(name: str, result: Result) -> None:
+    print('%s: %s (%.3f s)' % (name, 'OK' if result.ok else 'FAIL', result.seconds))
+    for note in result.notes:
+        print('  note: %s' % note)
+    for error in result.errors:
+        print('  error: %s' % error)
+
+def main(argv: typing.Optional[typing.List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description='Checks that BYML files survive round trips through the parser, the writer and YAML.')
+    parser.add_argument('paths', nargs='*', metavar='PATH', help='BYML files or directories (default: test_data)')
+    parser.add_argument('-n', '--jobs', type=int, default=None, help='Number of worker processes (default: number of CPUs)')
+    parser.add_argument('--no-tools', action='store_true', help='Do not check the command line tools (which are run on the smallest file)')
+    args = parser.parse_args(argv)
+
+    failures = 0
+    paths: typing.List[str] = []
+    start = time.perf_counter()
+    for result in verify_files(args.paths or [bench.DEFAULT_DOCUMENT_DIR], args.jobs):
+        paths.append(result.path)
+        _print_result(result.path, result)
+        if not result.ok:
+            failures += 1
+    if paths and not args.no_tools:
+        result = check_tools(min(paths, key=os.path.getsize))
+        _print_result('tools (%s)' % result.path, result)
+        if not result.ok:
+            failures += 1
+    print('verified %u file(s), %u failed in %.3f s' % (len(paths), failures, time.perf_counter() - start))
+    if failures or not paths:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,362 @@
+"""A YAML emitter specialised for BYML documents.
+
+This produces exactly the same text as yaml.dump(root, Dumper=yaml.CDumper, allow_unicode=True,
+default_flow_style=None) with the representers from yaml_util, but it walks the document directly
+instead of going through PyYAML's representer, serializer and event machinery. Layout decisions
+(flow vs block style, quoting, line folding at 80 columns, explicit keys) follow libyaml's emitter.
+
+Documents that cannot be emitted this way (non-container roots, binary data, shared nodes,
+strings that would need double quotes...) raise UnsupportedDataError so that callers can fall back
+to PyYAML.
+"""
+
+import typing
+
+from . import byml
+
+_BEST_INDENT = 2
+_BEST_WIDTH = 80
+_MAX_SIMPLE_KEY_LENGTH = 128
+
+_FLOW_INDICATORS = frozenset(',?[]{}')
+_FIRST_CHAR_INDICATORS = frozenset('#,[]{}&*!|>\'"%@`')
+
+class UnsupportedDataError(ValueError):
+    pass
+
+def _is_printable(c: str) -> bool:
+    # Matches libyaml's IS_PRINTABLE (which only considers characters from the BMP) minus line breaks.
+    o = ord(c)
+    return (0x20 <= o <= 0x7e or 0xa0 <= o <= 0xd7ff or (0xe000 <= o <= 0xfffd and o != 0xfeff)) \
+        and o != 0x2028 and o != 0x2029
+
+def _analyze(text: str) -> typing.Tuple[bool, bool]:
+    """Return whether text can be written as a plain scalar in flow and block context, respectively.
+
+    Raises UnsupportedDataError for strings that would have to be double quoted or broken over
+    several lines."""
+    if not text:
+        return (False, True)
+
+    flow_indicators = False
+    block_indicators = False
+    if text.startswith('---') or text.startswith('...'):
+        flow_indicators = True
+        block_indicators = True
+
+    length = len(text)
+    preceded_by_whitespace = True
+    for (i, c) in enumerate(text):
+        if not (' ' <= c <= '~') and not _is_printable(c):
+            raise UnsupportedDataError('string %r needs to be double quoted' % text)
+        followed_by_whitespace = i + 1 == length or text[i + 1] == ' '
+        if i == 0:
+            if c in _FIRST_CHAR_INDICATORS:
+                flow_indicators = True
+                block_indicators = True
+            elif c == '?' or c == ':':
+                flow_indicators = True
+                if followed_by_whitespace:
+                    block_indicators = True
+            elif c == '-' and followed_by_whitespace:
+                flow_indicators = True
+                block_indicators = True
+        else:
+            if c in _FLOW_INDICATORS:
+                flow_indicators = True
+            elif c == ':':
+                flow_indicators = True
+                if followed_by_whitespace:
+                    block_indicators = True
+            elif c == '#' and preceded_by_whitespace:
+                flow_indicators = True
+                block_indicators = True
+        preceded_by_whitespace = c == ' '
+
+    if text[0] == ' ' or text[-1] == ' ':
+        return (False, False)
+    return (not flow_indicators, not block_indicators)
+
+def _format_float(value: float) -> str:
+    # Same as yaml's SafeRepresenter.represent_float.
+    if value != value:
+        return '.nan'
+    if value == float('inf'):
+        return '.inf'
+    if value == -float('inf'):
+        return '-.inf'
+    text = repr(value).lower()
+    if '.' not in text and 'e' in text:
+        text = text.replace('e', '.0e', 1)
+    return text
+
+# Scalars that are always written as plain, untagged scalars.
+_PLAIN_SCALAR_FORMATTERS: typing.Dict[type, typing.Callable[[typing.Any], str]] = {
+    bool: lambda value: 'true' if value else 'false',
+    type(None): lambda value: 'null',
+    int: int.__repr__,
+    byml.Int: int.__repr__,
+    float: _format_float,
+    byml.Float: _format_float,
+}
+# Scalars that are written with an explicit local tag.
+_TAGGED_SCALAR_FORMATTERS: typing.Dict[type, typing.Tuple[str, typing.Callable[[typing.Any], str]]] = {
+    byml.UInt: ('!u', lambda value: '0x%08x' % value),
+    byml.Int64: ('!l', int.__repr__),
+    byml.UInt64: ('!ul', int.__repr__),
+    byml.Double: ('!f64', float.__repr__),
+}
+
+class _Emitter:
+    def __init__(self) -> None:
+        import yaml
+        self._resolver = yaml.resolver.Resolver()
+        self._scalar_node_type = yaml.ScalarNode
+        self._chunks: typing.List[str] = []
+        self._column = 0
+        self._whitespace = True
+        self._indention = True
+        self._flow_level = 0
+        self._seen_containers: typing.Set[int] = set()
+        # text -> (plain in flow context, plain in block context, simple key)
+        self._string_info: typing.Dict[str, typing.Tuple[bool, bool, bool]] = dict()
+
+    def emit(self, root) -> str:
+        if type(root) is not list and type(root) is not dict:
+            raise UnsupportedDataError('the root node must be an array or a hash')
+        self._emit_node(root, -1, False, False)
+        self._write_indent(-1)
+        return ''.join(self._chunks)
+
+    # Low level output helpers (yaml_emitter_write_indicator and yaml_emitter_write_indent)
+
+    def _write_indicator(self, indicator: str, need_whitespace: bool, is_whitespace: bool, is_indention: bool) -> None:
+        if need_whitespace and not self._whitespace:
+            self._chunks.append(' ')
+            self._column += 1
+        self._chunks.append(indicator)
+        self._column += len(indicator)
+        self._whitespace = is_whitespace
+        self._indention = self._indention and is_indention
+
+    def _write_indent(self, indent: int) -> None:
+        if indent < 0:
+            indent = 0
+        if not self._indention or self._column > indent or (self._column == indent and not self._whitespace):
+            self._chunks.append('\n')
+            self._column = 0
+        if self._column < indent:
+            self._chunks.append(' ' * (indent - self._column))
+            self._column = indent
+        self._whitespace = True
+        self._indention = True
+
+    # Nodes
+
+    def _is_flow_collection(self, data) -> bool:
+        # Mirrors PyYAML's default_flow_style=None: collections that only contain scalars use flow style.
+        t = type(data)
+        if t is list:
+            for item in data:
+                if type(item) is list or type(item) is dict:
+                    return False
+            return True
+        for item in data.values():
+            if type(item) is list or type(item) is dict:
+                return False
+        return True
+
+    def _emit_node(self, data, indent: int, mapping_context: bool, simple_key: bool) -> None:
+        t = type(data)
+        if t is list or t is dict:
+            if id(data) in self._seen_containers:
+                raise UnsupportedDataError('shared nodes must be emitted with aliases')
+            self._seen_containers.add(id(data))
+            if t is list:
+                if self._flow_level or not data or self._is_flow_collection(data):
+                    self._emit_flow_sequence(data, indent)
+                else:
+                    self._emit_block_sequence(data, indent, mapping_context)
+            else:
+                items = self._sorted_items(data)
+                if self._flow_level or not items or self._is_flow_collection(data):
+                    self._emit_flow_mapping(items, indent)
+                else:
+                    self._emit_block_mapping(items, indent)
+        else:
+            self._emit_scalar(data, indent, simple_key)
+
+    @staticmethod
+    def _sorted_items(data: dict) -> list:
+        items = list(data.items())
+        try:
+            return sorted(items)
+        except TypeError:
+            return items
+
+    def _emit_block_sequence(self, data: list, indent: int, mapping_context: bool) -> None:
+        if indent < 0:
+            indent = 0
+        elif not (mapping_context and not self._indention):
+            indent += _BEST_INDENT
+        for item in data:
+            self._write_indent(indent)
+            self._write_indicator('-', True, False, True)
+            self._emit_node(item, indent, False, False)
+
+    def _emit_block_mapping(self, items: list, indent: int) -> None:
+        indent = 0 if indent < 0 else indent + _BEST_INDENT
+        for (key, value) in items:
+            self._write_indent(indent)
+            if self._check_simple_key(key):
+                self._emit_node(key, indent, True, True)
+                self._write_indicator(':', False, False, False)
+            else:
+                self._write_indicator('?', True, False, True)
+                self._emit_node(key, indent, True, False)
+                self._write_indent(indent)
+                self._write_indicator(':', True, False, True)
+            self._emit_node(value, indent, True, False)
+
+    def _emit_flow_sequence(self, data: list, indent: int) -> None:
+        self._write_indicator('[', True, True, False)
+        indent = _BEST_INDENT if indent < 0 else indent + _BEST_INDENT
+        self._flow_level += 1
+        first = True
+        for item in data:
+            if not first:
+                self._write_indicator(',', False, False, False)
+            first = False
+            if self._column > _BEST_WIDTH:
+                self._write_indent(indent)
+            self._emit_node(item, indent, False, False)
+        self._flow_level -= 1
+        self._write_indicator(']', False, False, False)
+
+    def _emit_flow_mapping(self, items: list, indent: int) -> None:
+        self._write_indicator('{', True, True, False)
+        indent = _BEST_INDENT if indent < 0 else indent + _BEST_INDENT
+        self._flow_level += 1
+        first = True
+        for (key, value) in items:
+            if not first:
+                self._write_indicator(',', False, False, False)
+            first = False
+            if self._column > _BEST_WIDTH:
+                self._write_indent(indent)
+            if self._check_simple_key(key):
+                self._emit_node(key, indent, True, True)
+                self._write_indicator(':', False, False, False)
+            else:
+                self._write_indicator('?', True, False, False)
+                self._emit_node(key, indent, True, False)
+                if self._column > _BEST_WIDTH:
+                    self._write_indent(indent)
+                self._write_indicator(':', True, False, False)
+            self._emit_node(value, indent, True, False)
+        self._flow_level -= 1
+        self._write_indicator('}', False, False, False)
+
+    # Scalars
+
+    def _get_string_info(self, text: str) -> typing.Tuple[bool, bool, bool]:
+        info = self._string_info.get(text)
+        if info is None:
+            (flow_plain, block_plain) = _analyze(text)
+            if self._resolver.resolve(self._scalar_node_type, text, (True, False)) != 'tag:yaml.org,2002:str':
+                # The string would be read back as something else (e.g. a number) if it were not quoted.
+                flow_plain = block_plain = False
+            info = (flow_plain, block_plain, len(text.encode('utf-8')) <= _MAX_SIMPLE_KEY_LENGTH)
+            self._string_info[text] = info
+        return info
+
+    def _check_simple_key(self, key) -> bool:
+        t = type(key)
+        if t is str:
+            return self._get_string_info(key)[2]
+        if t is list or t is dict:
+            raise UnsupportedDataError('hash keys must be scalars')
+        return True
+
+    def _emit_scalar(self, data, indent: int, simple_key: bool) -> None:
+        t = type(data)
+        if t is str:
+            info = self._get_string_info(data)
+            plain = info[0] if self._flow_level else info[1]
+            self._write_scalar(data, plain, indent, not simple_key)
+            return
+
+        formatter = _PLAIN_SCALAR_FORMATTERS.get(t)
+        if formatter is not None:
+            self._write_scalar(formatter(data), True, indent, not simple_key)
+            return
+
+        tagged_formatter = _TAGGED_SCALAR_FORMATTERS.get(t)
+        if tagged_formatter is None:
+            raise UnsupportedDataError('cannot emit %s' % t.__name__)
+        (tag, formatter) = tagged_formatter
+        text = formatter(data)
+        (flow_plain, block_plain) = _analyze(text)
+        if not self._whitespace:
+            self._chunks.append(' ')
+            self._column += 1
+        self._chunks.append(tag)
+        self._column += len(tag)
+        self._whitespace = False
+        self._indention = False
+        self._write_scalar(text, flow_plain if self._flow_level else block_plain, indent, not simple_key)
+
+    def _write_scalar(self, text: str, plain: bool, indent: int, allow_breaks: bool) -> None:
+        # Scalars are written with an increased indentation level (which only matters for folded lines).
+        indent = _BEST_INDENT if indent < 0 else indent + _BEST_INDENT
+        if plain:
+            if not self._whitespace:
+                self._chunks.append(' ')
+                self._column += 1
+            if allow_breaks and self._column + len(text) > _BEST_WIDTH and ' ' in text:
+                self._write_folded(text, indent, False)
+            else:
+                self._chunks.append(text)
+                self._column += len(text)
+        else:
+            self._write_indicator("'", True, False, False)
+            if allow_breaks and self._column + len(text) > _BEST_WIDTH and ' ' in text:
+                self._write_folded(text, indent, True)
+            else:
+                escaped = text.replace("'", "''")
+                self._chunks.append(escaped)
+                self._column += len(escaped)
+            self._chunks.append("'")
+            self._column += 1
+        self._whitespace = False
+        self._indention = False
+
+    def _write_folded(self, text: str, indent: int, single_quoted: bool) -> None:
+        # Line folding for long plain and single quoted scalars: a single space that occurs past
+        # the preferred line width is replaced with a line break.
+        last = len(text) - 1
+        spaces = False
+        for (i, c) in enumerate(text):
+            if c == ' ':
+                if (not spaces and self._column > _BEST_WIDTH and (i == last or text[i + 1] != ' ')
+                        and (not single_quoted or 0 < i < last)):
+                    self._write_indent(indent)
+                else:
+                    self._chunks.append(' ')
+                    self._column += 1
+                spaces = True
+            else:
+                if single_quoted and c == "'":
+                    self._chunks.append("''")
+                    self._column += 2
+                else:
+                    self._chunks.append(c)
+                    self._column += 1
+                self._indention = False
+                spaces = False
+
+def dumps(root) -> str:
+    """Emit a parsed BYML document (an array or a hash) as YAML text.
+
+    Raises UnsupportedDataError if the document cannot be emitted without going through PyYAML."""
+    return _Emitter().emit(root)
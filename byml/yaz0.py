@@ -0,0 +1,96 @@
+"""Yaz0 compression and decompression.
+
+Decompression does not go through intermediate copies of the data."""
+import struct
+import typing
+
+_HEADER = struct.Struct('>4sII')
+_HEADER_SIZE = 16
+DEFAULT_COMPRESSION_LEVEL = 7
+COMPRESSION_LEVELS = range(6, 10)
+
+def is_compressed(data) -> bool:
+    return bytes(data[0:4]) == b'Yaz0'
+
+def get_decompressed_size(data) -> int:
+    magic, size, _ = _HEADER.unpack_from(data, 0)
+    if magic != b'Yaz0':
+        raise ValueError("Invalid magic: %s (expected 'Yaz0')" % magic)
+    return size
+
+def compress(data, level: int = DEFAULT_COMPRESSION_LEVEL):
+    """Compress data with oead. Higher levels (6-9) are slower and produce smaller outputs.
+
+    oead releases the GIL while compressing, so several buffers can be compressed in parallel
+    on a thread pool."""
+    import oead
+    return oead.yaz0.compress(data, level=level)
+
+def decompress(data) -> typing.Union[bytearray, memoryview]:
+    """Decompress Yaz0 data (any buffer, e.g. an mmap of a compressed file).
+
+    The result is a single buffer that can be passed to byml.Byml as is. oead is used if it is
+    installed; otherwise the data is decompressed straight into a buffer that is allocated once,
+    using the size from the Yaz0 header.
+    """
+    size = get_decompressed_size(data)
+    try:
+        import oead
+    except ImportError:
+        pass
+    else:
+        return memoryview(oead.yaz0.decompress(data))
+    output = bytearray(size)
+    decompress_into(data, output)
+    return output
+
+def decompress_into(data, output) -> None:
+    """Decompress Yaz0 data into output, a writable buffer (such as a bytearray or an mmap) whose size
+    is the decompressed size."""
+    size = len(output)
+    if get_decompressed_size(data) != size:
+        raise ValueError("Output size mismatch: %u (expected %u)" % (size, get_decompressed_size(data)))
+    src = _HEADER_SIZE
+    dst = 0
+    try:
+        while dst < size:
+            header = data[src]
+            src += 1
+            if header == 0xff and dst + 8 <= size and src + 8 <= len(data):
+                # Eight literal bytes (the common case for poorly compressible data).
+                output[dst:dst + 8] = data[src:src + 8]
+                src += 8
+                dst += 8
+                continue
+            for bit in (0x80, 0x40, 0x20, 0x10, 0x08, 0x04, 0x02, 0x01):
+                if dst >= size:
+                    break
+                if header & bit:
+                    output[dst] = data[src]
+                    src += 1
+                    dst += 1
+                    continue
+                # Back reference: 4-bit length, 12-bit distance and an extra length byte if the
+                # length is 0.
+                b1 = data[src]
+                distance = ((b1 & 0xf) << 8 | data[src + 1]) + 1
+                length = b1 >> 4
+                if length:
+                    length += 2
+                    src += 2
+                else:
+                    length = data[src + 2] + 0x12
+                    src += 3
+                start = dst - distance
+                if start < 0:
+                    raise ValueError("Invalid Yaz0 back reference at offset 0x%x" % src)
+                length = min(length, size - dst)
+                if distance >= length:
+                    output[dst:dst + length] = output[start:start + length]
+                else:
+                    # The copy overlaps the bytes it produces, i.e. the last distance bytes repeat.
+                    pattern = bytes(output[start:dst])
+                    output[dst:dst + length] = (pattern * (length // distance + 1))[:length]
+                dst += length
+    except IndexError:
+        raise ValueError("Truncated Yaz0 data") from None
@@ -1,13 +1,199 @@
 import argparse
-import io
 import os
-import shutil
 import sys
-import yaml
+import typing
 
 from . import byml
-import oead
-from . import yaml_util
+from . import cache as byml_cache
+from . import yaz0
+
+def _get_loader():
+    import yaml
+    from . import yaml_util
+    loader = yaml.CSafeLoader
+    yaml_util.add_constructors(loader)
+    return loader
+
+def load_yml(file: typing.Union[typing.TextIO, bytes]):
+    import yaml
+    return yaml.load(file, Loader=_get_loader())
+
+class _UnsupportedDocument(Exception):
+    pass
+
+_MISSING = object()
+
+def _build_from_events(yml_data: typing.Union[str, bytes]) -> typing.Tuple[typing.Any, typing.Set[str], typing.Set[str]]:
+    """Build a document directly from the parser's event stream.
+
+    This skips PyYAML's composer and constructor (and most implicit tag resolution, since the
+    result is cached per distinct scalar) and collects the hash keys and strings for the writer's
+    string tables along the way. Documents that use YAML features which are never needed for BYML
+    (merge keys, non-scalar keys, custom collection tags...) raise _UnsupportedDocument.
+    """
+    import yaml
+    ScalarEvent = yaml.ScalarEvent
+    AliasEvent = yaml.AliasEvent
+    SequenceStartEvent = yaml.SequenceStartEvent
+    MappingStartEvent = yaml.MappingStartEvent
+    CollectionEndEvent = yaml.CollectionEndEvent
+    str_tag = 'tag:yaml.org,2002:str'
+    merge_tag = 'tag:yaml.org,2002:merge'
+
+    loader = _get_loader()(yml_data)
+    try:
+        loader.get_event()
+        if not loader.check_event(yaml.DocumentStartEvent):
+            raise _UnsupportedDocument()
+        loader.get_event()
+
+        constructors = loader.yaml_constructors
+        plain_scalars: typing.Dict[str, typing.Any] = dict()
+        tagged_scalars: typing.Dict[typing.Tuple[typing.Optional[str], typing.Tuple[bool, bool], str], typing.Any] = dict()
+        anchors: typing.Dict[str, typing.Any] = dict()
+        hash_keys: typing.Set[str] = set()
+        strings: typing.Set[str] = set()
+
+        # Enclosing containers, as (container, is_mapping, pending_key) tuples.
+        stack: typing.List[typing.Tuple[typing.Any, bool, typing.Any]] = []
+        container: typing.Any = None
+        is_mapping = False
+        key: typing.Any = _MISSING
+        while True:
+            event = loader.get_event()
+            t = type(event)
+            if t is ScalarEvent:
+                text = event.value
+                if event.tag is None and event.implicit[0]:
+                    value = plain_scalars.get(text, _MISSING)
+                    cache_key = text
+                    cache = plain_scalars
+                elif event.tag is None:
+                    value = text
+                else:
+                    cache_key = (event.tag, event.implicit, text)
+                    cache = tagged_scalars
+                    value = cache.get(cache_key, _MISSING)
+                if value is _MISSING:
+                    tag = event.tag
+                    if tag is None or tag == '!':
+                        tag = loader.resolve(yaml.ScalarNode, text, event.implicit)
+                    if tag == str_tag:
+                        value = text
+                    else:
+                        constructor = constructors.get(tag)
+                        if constructor is None or tag == merge_tag:
+                            raise _UnsupportedDocument()
+                        value = constructor(loader, yaml.ScalarNode(tag, text, style=event.style))
+                    cache[cache_key] = value
+                if event.anchor is not None:
+                    anchors[event.anchor] = value
+            elif t is AliasEvent:
+                value = anchors.get(event.anchor, _MISSING)
+                if value is _MISSING:
+                    raise _UnsupportedDocument()
+            elif t is SequenceStartEvent or t is MappingStartEvent:
+                if event.tag not in (None, '!', 'tag:yaml.org,2002:seq' if t is SequenceStartEvent else 'tag:yaml.org,2002:map'):
+                    raise _UnsupportedDocument()
+                value = [] if t is SequenceStartEvent else {}
+                if event.anchor is not None:
+                    anchors[event.anchor] = value
+                if container is not None:
+                    if not is_mapping:
+                        container.append(value)
+                    elif key is _MISSING:
+                        raise _UnsupportedDocument()
+                    else:
+                        container[key] = value
+                stack.append((container, is_mapping, key))
+                container = value
+                is_mapping = t is MappingStartEvent
+                key = _MISSING
+                continue
+            elif isinstance(event, CollectionEndEvent):
+                value = container
+                (container, is_mapping, key) = stack.pop()
+                if container is None:
+                    break
+                key = _MISSING
+                continue
+            else:
+                raise _UnsupportedDocument()
+
+            if container is None:
+                break
+            if not is_mapping:
+                container.append(value)
+                if isinstance(value, str):
+                    strings.add(value)
+            elif key is _MISSING:
+                if isinstance(value, (list, dict)):
+                    raise _UnsupportedDocument()
+                key = value
+                hash_keys.add(key)
+            else:
+                container[key] = value
+                if isinstance(value, str):
+                    strings.add(value)
+                key = _MISSING
+
+        # Only single document streams are supported (like yaml.load).
+        if not loader.check_event(yaml.DocumentEndEvent):
+            raise _UnsupportedDocument()
+        loader.get_event()
+        if not loader.check_event(yaml.StreamEndEvent):
+            raise _UnsupportedDocument()
+    finally:
+        loader.dispose()
+    return (value, hash_keys, strings)
+
+def make_writer(yml_data: typing.Union[str, bytes], be: bool = False, version: int = 2, stats: bool = False) -> byml.Writer:
+    """Load a YAML document and return a BYML writer for it."""
+    try:
+        (root, hash_keys, strings) = _build_from_events(yml_data)
+    except _UnsupportedDocument:
+        return byml.Writer(load_yml(yml_data), be=be, version=version, stats=stats)
+    return byml.Writer(root, be=be, version=version, hash_keys=hash_keys, strings=strings, stats=stats)
+
+def should_compress(byml_path: str) -> bool:
+    """Whether a BYML file should be Yaz0 compressed, based on its extension."""
+    return os.path.splitext(byml_path)[1].startswith('.s')
+
+def convert_data(yml_data: bytes, be: bool = False, version: int = 2, compress: bool = False,
+                 compression_level: int = yaz0.DEFAULT_COMPRESSION_LEVEL) -> bytes:
+    """Convert a YAML document to BYML."""
+    writer = make_writer(yml_data, be, version)
+    if compress:
+        return yaz0.compress(writer.get_buffer(), compression_level)
+    return writer.get_bytes()
+
+def convert_cached(yml_data: bytes, cache: byml_cache.ConversionCache, be: bool = False, version: int = 2,
+                   compress: bool = False, compression_level: int = yaz0.DEFAULT_COMPRESSION_LEVEL) -> bytes:
+    """Convert a YAML document to BYML, reusing the cached output if there is one."""
+    key = cache.make_key(yml_data, tool='yml_to_byml', be=be, version=version, compress=compress,
+                         compression_level=compression_level if compress else None)
+    data = cache.get(key)
+    if data is None:
+        data = convert_data(yml_data, be, version, compress, compression_level)
+        cache.put(key, data)
+    return data
+
+def convert(yml_path: str, byml_path: str, be: bool = False, version: int = 2,
+            cache: typing.Optional[byml_cache.ConversionCache] = None, compress: typing.Optional[bool] = None,
+            compression_level: int = yaz0.DEFAULT_COMPRESSION_LEVEL) -> None:
+    """Convert a YAML file to BYML. By default, the output is compressed if its extension starts with .s"""
+    if compress is None:
+        compress = should_compress(byml_path)
+    if cache is not None:
+        with open(yml_path, 'rb') as binary_file:
+            data = convert_cached(binary_file.read(), cache, be, version, compress, compression_level)
+    else:
+        with open(yml_path, 'r', encoding='utf-8') as file:
+            data = make_writer(file.read(), be, version).get_buffer()
+        if compress:
+            data = yaz0.compress(data, compression_level)
+    with open(byml_path, 'wb') as output:
+        output.write(data)
 
 def main() -> None:
     parser = argparse.ArgumentParser(description='Converts a YAML file to BYML.')
@@ -15,32 +201,54 @@ def main() -> None:
     parser.add_argument('byml', help='Path to destination BYAML file', nargs='?', default='-')
     parser.add_argument('-V', '--version', type=int, default=2, help='BYML version (1, 2, 3)')
     parser.add_argument('-b', '--be', action='store_true', help='Use big endian. Defaults to false.')
+    parser.add_argument('-l', '--compression-level', type=int, choices=yaz0.COMPRESSION_LEVELS,
+                        default=yaz0.DEFAULT_COMPRESSION_LEVEL,
+                        help='Yaz0 compression level for .s* outputs (6 is the fastest, 9 gives the smallest files)')
+    parser.add_argument('--cache', metavar='DIR', help='Store conversion results in DIR and reuse them for identical inputs')
+    parser.add_argument('--cache-size', type=int, default=byml_cache.DEFAULT_MAX_SIZE // (1024*1024), metavar='MB',
+                        help='Maximum size of the cache in MiB')
+    parser.add_argument('--stats', action='store_true', help='Print statistics about the document to stderr (not with --cache)')
     args = parser.parse_args()
 
-    loader = yaml.CSafeLoader
-    yaml_util.add_constructors(loader)
-
-    file = sys.stdin if args.yml == '-' else open(args.yml, 'r', encoding='utf-8')
-    with file:
-        root = yaml.load(file, Loader=loader)
-        buf = io.BytesIO()
-        byml.Writer(root, be=args.be, version=args.version).write(buf)
-        buf.seek(0)
-
+    if args.cache:
+        file = sys.stdin.buffer if args.yml == '-' else open(args.yml, 'rb')
+        with file:
+            yml_data = file.read()
         if args.yml != '-':
             args.byml = args.byml.replace('!!', os.path.splitext(args.yml)[0])
         elif '!!' in args.byml:
             sys.stderr.write('error: cannot use !! (for input filename) when reading from stdin\n')
             sys.exit(1)
-
-        if args.byml != '-':
-            extension = os.path.splitext(args.byml)[1]
-            if extension.startswith('.s'):
-                buf = io.BytesIO(oead.yaz0.compress(buf.read()))
-
+        cache = byml_cache.ConversionCache(args.cache, args.cache_size * 1024*1024)
+        data = convert_cached(yml_data, cache, args.be, args.version, args.byml != '-' and should_compress(args.byml),
+                              args.compression_level)
         output = sys.stdout.buffer if args.byml == '-' else open(args.byml, 'wb')
         with output:
-            shutil.copyfileobj(buf, output)
+            output.write(data)
+        return
+
+    file = sys.stdin if args.yml == '-' else open(args.yml, 'r', encoding='utf-8')
+    with file:
+        writer = make_writer(file.read(), args.be, args.version, stats=args.stats)
+
+    if args.yml != '-':
+        args.byml = args.byml.replace('!!', os.path.splitext(args.yml)[0])
+    elif '!!' in args.byml:
+        sys.stderr.write('error: cannot use !! (for input filename) when reading from stdin\n')
+        sys.exit(1)
+
+    # Compress before opening the output so that a failure does not leave an empty file behind.
+    data = None
+    if args.byml != '-' and should_compress(args.byml):
+        data = yaz0.compress(writer.get_buffer(), args.compression_level)
+    output = sys.stdout.buffer if args.byml == '-' else open(args.byml, 'wb')
+    with output:
+        if data is not None:
+            output.write(data)
+        else:
+            writer.write(output)
+    if writer.stats is not None:
+        sys.stderr.write('%s\n' % writer.stats)
 
 if __name__ == '__main__':
     main()
@@ -22,11 +22,13 @@ setuptools.setup(
         "Topic :: Software Development :: Libraries",
     ],
     python_requires='>=3.6',
-    install_requires=['PyYAML~=6.0', 'sortedcontainers~=2.0', 'oead~=1.1'],
+    install_requires=['PyYAML~=6.0', 'oead~=1.1'],
     entry_points = {
         'console_scripts': [
             'byml_to_yml = byml.byml_to_yml:main',
-            'yml_to_byml = byml.yml_to_byml:main'
+            'yml_to_byml = byml.yml_to_byml:main',
+            'byml_batch = byml.byml_batch:main',
+            'byml_client = byml.client:main'
         ]
     },
 )
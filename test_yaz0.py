@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""Tests for the pure-Python Yaz0 decoder (byml.yaz0.decompress_into), which is not used when oead is installed."""
+import random
+import struct
+
+from byml import yaz0
+
+def make_yaz0(size: int, body: bytes) -> bytes:
+    return b'Yaz0' + struct.pack('>II', size, 0) + b'\x00' * 4 + body
+
+def back_reference(distance: int, length: int) -> bytes:
+    if length >= 0x12:
+        return bytes([(distance - 1) >> 8, (distance - 1) & 0xff, length - 0x12])
+    return bytes([(length - 2) << 4 | (distance - 1) >> 8, (distance - 1) & 0xff])
+
+def compress(data: bytes) -> bytes:
+    """Greedy reference encoder that uses every kind of back reference."""
+    body = bytearray()
+    i = 0
+    while i < len(data):
+        header_offset = len(body)
+        body.append(0)
+        header = 0
+        for bit in range(8):
+            if i >= len(data):
+                break
+            (best_length, best_distance) = (0, 0)
+            for distance in range(1, min(i, 0x1000) + 1):
+                length = 0
+                while length < 0x111 and i + length < len(data) and data[i + length] == data[i - distance + length]:
+                    length += 1
+                if length > best_length:
+                    (best_length, best_distance) = (length, distance)
+            if best_length >= 3:
+                body += back_reference(best_distance, best_length)
+                i += best_length
+            else:
+                header |= 0x80 >> bit
+                body.append(data[i])
+                i += 1
+        body[header_offset] = header
+    return make_yaz0(len(data), bytes(body))
+
+def decompress(data: bytes) -> bytes:
+    output = bytearray(yaz0.get_decompressed_size(data))
+    yaz0.decompress_into(data, output)
+    return bytes(output)
+
+def expect_error(data: bytes) -> None:
+    try:
+        decompress(data)
+    except ValueError:
+        return
+    raise AssertionError('no error for invalid data')
+
+def main() -> None:
+    # Literals only (eight at a time, then fewer at the end)
+    assert decompress(make_yaz0(10, b'\xff' + b'abcdefgh' + b'\xc0' + b'ij')) == b'abcdefghij'
+    # Non-overlapping back reference
+    assert decompress(make_yaz0(7, b'\xf0' + b'abcd' + back_reference(4, 3))) == b'abcdabc'
+    # Overlapping back references: a run of one byte and a repeated pattern
+    assert decompress(make_yaz0(11, b'\x80' + b'a' + back_reference(1, 10))) == b'a' * 11
+    assert decompress(make_yaz0(9, b'\xc0' + b'ab' + back_reference(2, 7))) == b'abababab' + b'a'
+    # Three-byte back references (length >= 0x12), up to the maximum length
+    assert decompress(make_yaz0(3 + 0x111, b'\xe0' + b'xyz' + back_reference(3, 0x111))) == b'xyz' * ((3 + 0x111) // 3)
+    assert decompress(make_yaz0(1 + 0x12, b'\x80' + b'q' + back_reference(1, 0x12))) == b'q' * (1 + 0x12)
+    # A back reference that goes past the end of the output is truncated.
+    assert decompress(make_yaz0(5, b'\x80' + b'a' + back_reference(1, 10))) == b'a' * 5
+
+    # Invalid data
+    expect_error(make_yaz0(10, b'\xff' + b'abc'))
+    expect_error(make_yaz0(10, b'\x80' + b'a' + b'\x00'))
+    expect_error(make_yaz0(4, b'\x00' + back_reference(1, 4)))
+    expect_error(b'Yaz1' + bytes(12))
+
+    # Round trips with the reference encoder
+    rnd = random.Random(0)
+    for _ in range(300):
+        alphabet = bytes(rnd.sample(range(256), rnd.randrange(1, 6)))
+        data = bytes(rnd.choice(alphabet) for _ in range(rnd.randrange(0, 700)))
+        assert decompress(compress(data)) == data, data
+    data = bytes(rnd.randrange(256) for _ in range(800))
+    assert decompress(compress(data)) == data
+    print('yaz0 OK')
+
+if __name__ == '__main__':
+    main()